@@ -4,129 +4,352 @@ agglib
 
 A reusable module library of things useful for feed aggregator.
 """
-import sys, time, feedparser, feedfinder, shelve, md5, time
+import sys, os.path, time, feedparser, feedfinder, shelve, md5, time
+import threading, Queue
+from itertools import islice
+from operator import attrgetter
+from urlparse import urlparse
+from pollsched import PollScheduler, nextPoll, DEFAULT_INTERVAL
+from seenlib import SeenEntryStore
 
 UNICODE_ENC = "utf-8"
 
+# Maximum number of feeds fetched at once, overall and per host.
+POLL_MAX_THREADS  = 10
+POLL_HOST_THREADS = 2
+
+# Index link to a page of entries, when splitting aggregator output.
+PAGE_LINK_TMPL = """
+    <li><a href="%(href)s">Page %(page)s</a>: 
+        %(count)s entries, %(first)s to %(last)s</li>
+"""
+
 def openDBs(feed_db_fn, entry_db_fn):
     """
     Open the databases used to track feeds and entries seen.
     """
     feed_db  = shelve.open(feed_db_fn)
-    entry_db = shelve.open(entry_db_fn)
+    entry_db = SeenEntryStore(entry_db_fn)
     return (feed_db, entry_db)
 
 def closeDBs(feed_db, entry_db):
     """
-    Close the databases used to track feeds and entries seen.
+    Close the databases used to track feeds and entries seen, pruning
+    entries seen too long ago to matter.
     """
     feed_db.close()
+    if hasattr(entry_db, 'prune'): entry_db.prune()
     entry_db.close()
 
-def getNewFeedEntries(feeds, feed_db, entry_db):
+def getNewFeedEntries(feeds, feed_db, entry_db, 
+        max_threads=POLL_MAX_THREADS, host_threads=POLL_HOST_THREADS):
     """
-    Given a list of feeds, poll feeds which have not been polled in over
-    an hour.  Look out for conditional HTTP GET status codes before 
-    processing feed data.  Check if we've seen each entry in a feed,
-    collecting any entries that are new.  Sort the entries, then return 
-    the list.
+    Given a list of feeds, poll feeds which are due according to the
+    polling schedule kept in the feed DB.  Look out for conditional HTTP
+    GET status codes before processing feed data.  Check if we've seen
+    each entry in a feed, collecting any entries that are new.  Sort the
+    entries, then return the list.
+
+    Fetching and parsing is spread across a pool of up to max_threads 
+    worker threads, with no more than host_threads of them hitting any 
+    one host at a time.  All reads and writes to the databases happen
+    here in the calling thread.
     """
-    entries = []
+    entries, polls = [], []
+    sched, now = PollScheduler(feed_db), time.time()
     for uri in feeds:
+        # Get the notes rememebered for this feed.
+        feed_data = feed_db.get(uri, {})
+        last_poll = feed_data.get('last_poll', None)
+        etag      = feed_data.get('etag', None)
+        modified  = feed_data.get('modified', None)
+        
+        # Work out when this feed is next due, falling back to an hour
+        # after the last poll for feeds noted before scheduling.
+        next_poll = sched.nextPollTime(uri) or \
+                    feed_data.get('next_poll', None)
+        if next_poll is None and last_poll:
+            next_poll = last_poll + DEFAULT_INTERVAL
+
+        # Check to see whether it's time to poll this feed yet.
+        if next_poll and now < next_poll:
+            print "Polling %s" % uri
+            print "\tFeed not due for polling until %s." % \
+                time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(next_poll))
+        else:
+            # Queue up the feed to be fetched with the ETag and 
+            # Last-Modified notes.
+            polls.append( (uri, etag, modified) )
+
+    # Fetch the feeds due for polling, handling each one as it arrives.
+    for uri, feed_data, error in pollFeeds(polls, max_threads, host_threads):
         print "Polling %s" % uri
         try:
-            # Get the notes rememebered for this feed.
-            feed_data = feed_db.get(uri, {})
-            last_poll = feed_data.get('last_poll', None)
-            etag      = feed_data.get('etag', None)
-            modified  = feed_data.get('modified', None)
+            if error is not None: raise error
+            new_entries = 0
             
-            # Check to see whether it's time to poll this feed yet.
-            if last_poll and (time.time() - last_poll) < 3600:
-                print "\tFeed already polled within the last hour."
+            # If the feed HTTP status is 304, there was no change.
+            if feed_data.status == 304:
+                print "\tFeed unchanged."
             
             else:
-                # Fetch the feed using the ETag and Last-Modified notes.
-                feed_data = feedparser.parse(uri,etag=etag,modified=modified)
-                
-                # If the feed HTTP status is 304, there was no change.
-                if feed_data.status == 304:
-                    print "\tFeed unchanged."
+                new_hashes = {}
+                for entry_data in feed_data.entries:
                 
-                else:
-                    new_entries = 0
+                    # Wrap the entry data and get a hash for the entry.
+                    entry = EntryWrapper(feed_data, entry_data)
+                    hash  = entry.hash()
                     
-                    for entry_data in feed_data.entries:
-                    
-                        # Wrap the entry data and get a hash for the entry.
-                        entry = EntryWrapper(feed_data, entry_data)
-                        hash  = entry.hash()
-                        
-                        # If the hash for this entry is found in the DB, 
-                        # it's not new.
-                        if entry_db.has_key(hash): continue
-
-                        # Flag entry as seen with the hash key, append to 
-                        # list of new entries.
-                        entry_db[hash] = time.time()
-                        entries.append(entry)
-                        new_entries += 1
-                    
-                    print "\tFound %s new entries" % new_entries
+                    # If the hash for this entry is found in the DB, 
+                    # or earlier in this feed, it's not new.
+                    if new_hashes.has_key(hash) or entry_db.has_key(hash): 
+                        continue
 
-            # Finally, update the notes remembered for this feed.
-            if feed_data.has_key('feed') and feed_data['feed'].has_key('title'):
-                feed_title = feed_data['feed']['title']
-            else:
-                feed_title = 'Untitled'
-
-            feed_db[uri] = {
-                'last_poll' : time.time(),
-                'etag'      : feed_data.get('etag', None),
-                'modified'  : feed_data.get('modified', None),
-                'title'     : feed_title
-            }
+                    # Note the hash to be flagged as seen, append to 
+                    # list of new entries.
+                    new_hashes[hash] = 1
+                    entries.append(entry)
+                    new_entries += 1
+                
+                # Flag all the new entries for this feed as seen at once.
+                markEntriesSeen(entry_db, new_hashes.keys())
+                print "\tFound %s new entries" % new_entries
+
+            # Finally, update the notes remembered for this feed and 
+            # schedule its next poll.
+            updateFeedNotes(feed_db, uri, feed_data, sched, new_entries > 0)
             
         except KeyboardInterrupt:
             raise
         except Exception, e:
             print "Problem polling %s: %s" % (uri, e)
     
-    entries.sort()
+    sched.save()
+    entries.sort(key=attrgetter('sort_key'))
     return entries
 
+def markEntriesSeen(entry_db, hashes):
+    """
+    Flag a batch of entry hashes as seen, in one go if the entry DB 
+    supports it.
+    """
+    now = time.time()
+    if hasattr(entry_db, 'markSeen'):
+        entry_db.markSeen(hashes, now)
+    else:
+        for hash in hashes: entry_db[hash] = now
+
+def updateFeedNotes(feed_db, uri, feed_data, sched, changed):
+    """
+    Update the notes remembered for a feed after a poll, and schedule 
+    the next poll based on whether the feed had changed.
+    """
+    notes = feed_db.get(uri, {})
+
+    # A 304 response carries no feed data, so hang onto the old title
+    # and validators unless new ones arrived.
+    if feed_data.has_key('feed') and feed_data['feed'].has_key('title'):
+        feed_title = feed_data['feed']['title']
+    else:
+        feed_title = notes.get('title', 'Untitled')
+
+    next_poll, interval, history = nextPoll(feed_data, changed, 
+        notes.get('interval', None), notes.get('history', None))
+    sched.scheduleFeed(uri, next_poll)
+
+    feed_db[uri] = {
+        'last_poll' : time.time(),
+        'etag'      : feed_data.get('etag', notes.get('etag', None)),
+        'modified'  : feed_data.get('modified', notes.get('modified', None)),
+        'title'     : feed_title,
+        'next_poll' : next_poll,
+        'interval'  : interval,
+        'history'   : history
+    }
+
+def pollFeeds(polls, max_threads=POLL_MAX_THREADS, 
+        host_threads=POLL_HOST_THREADS):
+    """
+    Given a list of (uri, etag, modified) tuples, fetch and parse the
+    feeds using a pool of worker threads.  Yields a (uri, feed_data, 
+    error) tuple for each feed, in order of completion.
+    """
+    # With only one thread allowed, skip all the thread machinery.
+    if max_threads <= 1 or len(polls) <= 1:
+        for uri, etag, modified in polls:
+            yield fetchFeed(uri, etag, modified)
+        return
+        
+    # Queue up the feeds by host, in the order given.  Each host's
+    # feeds are handed out only while fewer than host_threads of its
+    # fetches are running, so a worker is never stuck holding a feed
+    # for a busy host while feeds for other hosts wait.
+    todo, active, hosts = {}, {}, []
+    for poll in polls:
+        host = urlparse(poll[0])[1].lower()
+        if not todo.has_key(host):
+            todo[host], active[host] = [], 0
+            hosts.append(host)
+        todo[host].append(poll)
+    cond, done_q = threading.Condition(), Queue.Queue()
+
+    def takePoll():
+        """
+        Return a (host, poll) for the next feed from a host under its 
+        limit, taking hosts in turn, or None once no feeds are left.  
+        Waits while every host with feeds left is at its limit.
+        """
+        cond.acquire()
+        try:
+            while True:
+                waiting = [ h for h in hosts if todo[h] ]
+                if not waiting: return None
+                for host in waiting:
+                    if active[host] < host_threads:
+                        hosts.remove(host)
+                        hosts.append(host)
+                        active[host] += 1
+                        return (host, todo[host].pop(0))
+                cond.wait()
+        finally:
+            cond.release()
+
+    def worker():
+        """Fetch feeds until none are left."""
+        while True:
+            taken = takePoll()
+            if taken is None: return
+            host, (uri, etag, modified) = taken
+            try:
+                done_q.put(fetchFeed(uri, etag, modified))
+            finally:
+                cond.acquire()
+                active[host] -= 1
+                cond.notifyAll()
+                cond.release()
+
+    # Fire up the worker threads.  These are daemons, so that a 
+    # KeyboardInterrupt in the main thread isn't held up by them.
+    for idx in range(min(max_threads, len(polls))):
+        t = threading.Thread(target=worker)
+        t.setDaemon(True)
+        t.start()
+
+    # Hand back the results as they arrive.  Wait with a timeout, so 
+    # that the main thread stays responsive to KeyboardInterrupt.
+    for idx in range(len(polls)):
+        while True:
+            try:
+                result = done_q.get(True, 1.0)
+                break
+            except Queue.Empty:
+                pass
+        yield result
+
+def fetchFeed(uri, etag=None, modified=None):
+    """
+    Fetch and parse a single feed, returning a (uri, feed_data, error)
+    tuple.  Safe to call from worker threads, since it touches no 
+    databases.
+    """
+    try:
+        return (uri, feedparser.parse(uri, etag=etag, modified=modified), 
+                None)
+    except KeyboardInterrupt:
+        raise
+    except Exception, e:
+        return (uri, None, e)
+
 def writeAggregatorPage(entries, out_fn, date_hdr_tmpl, feed_hdr_tmpl, 
-        entry_tmpl, page_tmpl):
+        entry_tmpl, page_tmpl, page_size=None, link_tmpl=PAGE_LINK_TMPL):
     """
     Given a list of entries and an output filename, use templates to compose
     an aggregate page from the feeds and write to the file.
+
+    If a page size is given, entries are split across numbered pages of
+    that many entries each, and the output file becomes an index page 
+    with a link to each of them.  Numbered pages left over from an 
+    earlier run with more pages are deleted.
     """
-    out, curr_day, curr_feed = [], None, None
+    if not page_size:
+        writeEntriesPage(entries, out_fn, date_hdr_tmpl, feed_hdr_tmpl,
+            entry_tmpl, page_tmpl)
+        return
+
+    # Write out the pages, one chunk of entries at a time, noting 
+    # details for the index as each is written.
+    pages, entries = [], iter(entries)
+    (out_root, out_ext) = os.path.splitext(out_fn)
+    while True:
+        page_entries = list(islice(entries, page_size))
+        if not page_entries: break
+        page_fn = "%s-%03d%s" % (out_root, len(pages) + 1, out_ext)
+        writeEntriesPage(page_entries, page_fn, date_hdr_tmpl, 
+            feed_hdr_tmpl, entry_tmpl, page_tmpl)
+        pages.append({
+            'href'  : os.path.basename(page_fn),
+            'page'  : len(pages) + 1,
+            'count' : len(page_entries),
+            'first' : "%(date)s %(time)s" % page_entries[0],
+            'last'  : "%(date)s %(time)s" % page_entries[-1]
+        })
+
+    # Clear out any higher numbered pages from an earlier, longer run.
+    page_num = len(pages) + 1
+    while True:
+        page_fn = "%s-%03d%s" % (out_root, page_num, out_ext)
+        if not os.path.exists(page_fn): break
+        os.remove(page_fn)
+        page_num += 1
+
+    # Fill the page template with links to all the pages for the index.
+    links = [ link_tmpl % x for x in pages ]
+    open(out_fn, "w").write(page_tmpl % ("<ul>%s</ul>" % "".join(links)))
+
+def writeEntriesPage(entries, out_fn, date_hdr_tmpl, feed_hdr_tmpl, 
+        entry_tmpl, page_tmpl):
+    """
+    Given entries and an output filename, use templates to compose a 
+    page and write it out piece by piece, without building the whole
+    page up in memory.
+    """
+    # Split the page template around the spot where the entries go.
+    page_head, page_foot = splitPageTemplate(page_tmpl)
+    
+    out, curr_day, curr_feed = open(out_fn, "w"), None, None
+    out.write(page_head)
 
     for e in entries:
         # If this entry's date is not the current running day, change the 
         # current day and add a date header to the page output.
         if e['date'] != curr_day:
             curr_day = e['date']
-            out.append(date_hdr_tmpl % curr_day)
+            out.write(date_hdr_tmpl % curr_day)
             
             # Oh yeah, and output a reminder of the current feed after the
             # day header if it hasn't changed.
             if e.feed.title == curr_feed:
-                out.append(feed_hdr_tmpl % e)
+                out.write(feed_hdr_tmpl % e)
         
         # If this entry's feed isn't the current running feed, change the
         # current feed and add a feed header to the page output.
         if e.feed.title != curr_feed:
             curr_feed = e.feed.title
-            out.append(feed_hdr_tmpl % e)
+            out.write(feed_hdr_tmpl % e)
         
         # Add the entry to the page output.
-        out.append(entry_tmpl % e)
+        out.write(entry_tmpl % e)
 
-    # Concatenate all the page output collected, fill the page templage, and
-    # write the result to the output file.
-    open(out_fn, "w").write(page_tmpl % "".join(out))
+    out.write(page_foot)
+    out.close()
+
+def splitPageTemplate(page_tmpl):
+    """
+    Split a page template with a single %s into the text before and
+    after it, with any other template escapes already handled.
+    """
+    marker = "\0ENTRIES\0"
+    return tuple((page_tmpl % marker).split(marker, 1))
 
 def sendEntriesViaIM(conn, to_nick, entries, im_chunk, feed_hdr_tmpl,
         entry_tmpl, msg_tmpl):
@@ -232,36 +455,76 @@ def subscribeFeed(feeds, uri):
         feeds.append(feed_uri)
         return feed_uri
 
-class EntryWrapper:
+class EntryWrapper(object):
+    """
+    Wraps feed and entry data for use in templates, sorting newest first.
+    The entry's date and the values handed to templates are each worked
+    out on first use and then remembered, so changes made to the entry
+    data after that won't show up.
+    """
+    __slots__ = ('data', 'feed', 'entry', '_date', '_fields')
+
     def __init__(self, data, entry): 
         """
         Initialize the wrapper with feed and entry data.
         """
-        self.data  = data
-        self.feed  = data.feed
-        self.entry = entry
+        self.data    = data
+        self.feed    = data.feed
+        self.entry   = entry
+        self._date   = None
+        self._fields = {}
+
+    def _getDate(self):
+        """
+        Work out the entry's date, in seconds, the first time it's needed.
+        """
+        if self._date is None:
+            entry, feed = self.entry, self.feed
+            
+            # Try to work out some sensible primary date for the entry, 
+            # fall back to the feed's date, and use the current time as 
+            # a last resort.
+            if entry.has_key("modified_parsed"):
+                self._date = time.mktime(entry.modified_parsed)
+            elif entry.has_key("issued_parsed"):
+                self._date = time.mktime(entry.issued_parsed)
+            elif feed.has_key("modified_parsed"):
+                self._date = time.mktime(feed.modified_parsed)
+            elif feed.has_key("issued_parsed"):
+                self._date = time.mktime(feed.issued_parsed)
+            else:
+                self._date = time.time()
         
-        # Try to work out some sensible primary date for the entry, fall
-        # back to the feed's date, and use the current time as a last resort.
-        if entry.has_key("modified_parsed"):
-            self.date = time.mktime(entry.modified_parsed)
-        elif entry.has_key("issued_parsed"):
-            self.date = time.mktime(entry.issued_parsed)
-        elif self.feed.has_key("modified_parsed"):
-            self.date = time.mktime(self.feed.modified_parsed)
-        elif self.feed.has_key("issued_parsed"):
-            self.date = time.mktime(self.feed.issued_parsed)
-        else:
-            self.date = time.time()
+        return self._date
+    date = property(_getDate)
+
+    def _getSortKey(self):
+        """
+        Sort key putting the newest entries first.
+        """
+        return -self._getDate()
+    sort_key = property(_getSortKey)
 
-    def __cmp__(self, other):
+    def __lt__(self, other):
         """
         Use the entry's date as the comparator for sorting & etc.
         """
-        return other.date - self.date
+        return self.sort_key < other.sort_key
     
     def __getitem__(self, name):
         """
+        Return a value for use in templates, encoded as a string.
+        """
+        fields = self._fields
+        if not fields.has_key(name):
+            fields[name] = self.getField(name)
+        return fields[name]
+
+    def getField(self, name):
+        """
+        Work out a template value, without remembering it.  Subclasses
+        wanting more fields should override this, rather than 
+        __getitem__.
         """
         # Handle access to feed data on keys starting with "feed."
         if name.startswith("feed."):
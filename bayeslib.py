@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+"""
+bayeslib.py
+
+Long-running Bayes classifier service, so that scripts and CGIs don't
+each load and save the whole training data.  The server holds a guesser
+in memory and answers train and guess calls over XML-RPC on localhost.
+Training events go to a write-ahead log as they happen, and the full
+data is only saved at checkpoints, every so many events or minutes.
+
+Clients use openGuesser(), which connects to the server if it's running
+and otherwise falls back to a local ClassifierStore on the same files.
+A lock file keeps more than one ClassifierStore from using the files at
+once.
+"""
+import sys, os, time, socket, struct, fcntl, httplib, xmlrpclib
+import cPickle as pickle
+from SimpleXMLRPCServer import SimpleXMLRPCServer
+from xml.parsers.expat import ExpatError
+from reverend.thomas import Bayes
+
+BAYES_DATA_FN = "bayesdata.dat"
+WAL_SUFFIX    = ".wal"
+TMP_SUFFIX    = ".tmp"
+LOCK_SUFFIX   = ".lock"
+
+# Seconds to wait for another ClassifierStore to let go of the files.
+LOCK_TIMEOUT  = 30
+
+SERVER_HOST   = "localhost"
+SERVER_PORT   = 8765
+SERVER_URL    = "http://%s:%s/" % (SERVER_HOST, SERVER_PORT)
+CLIENT_TIMEOUT = 10
+
+# Save the full training data after this many logged events, or once
+# there are any this many seconds after the last save.
+CHECKPOINT_EVENTS   = 100
+CHECKPOINT_INTERVAL = 5 * 60
+
+# Trailer appended to saved training data, recording the last logged
+# event the data includes.  Bayes.load() stops reading at the end of
+# the pickle, so the trailer doesn't get in its way.
+TRAILER_MAGIC  = "BAYESWAL"
+TRAILER_FORMAT = "<8sQ"
+TRAILER_SIZE   = struct.calcsize(TRAILER_FORMAT)
+
+def main():
+    """
+    Run the classifier server until interrupted.
+    Usage: bayeslib.py [data filename] [port]
+    """
+    data_fn = (len(sys.argv) > 1) and sys.argv[1] or BAYES_DATA_FN
+    port    = (len(sys.argv) > 2) and int(sys.argv[2]) or SERVER_PORT
+    store   = ClassifierStore(data_fn)
+    try:
+        serveClassifier(store, SERVER_HOST, port)
+    except KeyboardInterrupt:
+        pass
+    store.checkpoint()
+    store.close()
+
+class ClassifierStore:
+    """
+    Bayes guesser loaded from saved training data, with every training
+    event since the last save recorded in a write-ahead log.  Supports
+    the train, untrain, guess and save methods of a Bayes guesser.
+    Short-lived users should call close() when done, which leaves the
+    full save to a later checkpoint.
+    """
+    def __init__(self, data_fn=BAYES_DATA_FN,
+            checkpoint_events=CHECKPOINT_EVENTS,
+            checkpoint_interval=CHECKPOINT_INTERVAL,
+            lock_timeout=LOCK_TIMEOUT):
+        """
+        Lock the training data files, load the saved data, and replay
+        any training events logged since it was saved.  Raises IOError
+        if the files stay locked by another store for lock_timeout 
+        seconds.
+        """
+        self.data_fn             = data_fn
+        self.wal_fn              = data_fn + WAL_SUFFIX
+        self.checkpoint_events   = checkpoint_events
+        self.checkpoint_interval = checkpoint_interval
+        self.guesser             = Bayes()
+        self.saved_seq           = 0
+        self.pending             = 0
+        self.lock                = lockFile(data_fn + LOCK_SUFFIX,
+                                            lock_timeout)
+
+        # Time since the last checkpoint counts across runs.
+        try:
+            self.last_checkpoint = os.path.getmtime(data_fn)
+        except OSError:
+            self.last_checkpoint = time.time()
+
+        try:
+            self.guesser.load(data_fn)
+            self.saved_seq = readTrailer(data_fn)
+        except IOError:
+            pass
+        self.seq = self.saved_seq
+
+        self._replay()
+        self.wal = open(self.wal_fn, 'ab')
+        self.maybeCheckpoint()
+
+    def train(self, pool, text):
+        """Train the guesser with text for a pool, logging the event."""
+        self._apply('train', pool, text, True)
+
+    def untrain(self, pool, text):
+        """Untrain the guesser with text for a pool, logging the event."""
+        self._apply('untrain', pool, text, True)
+
+    def guess(self, text):
+        """Return a list of (pool, probability) guesses for text."""
+        return self.guesser.guess(text)
+
+    def guessMany(self, texts):
+        """Return a list of guesses for each of a list of texts."""
+        return [ self.guesser.guess(x) for x in texts ]
+
+    def save(self, data_fn=None):
+        """
+        Checkpoint the training data, for code written against Bayes.
+        Saving anywhere but the store's own file isn't supported.
+        """
+        self.checkpoint()
+
+    def close(self):
+        """
+        Checkpoint if one is due, then close the log and release the
+        lock.  Events since the last checkpoint stay in the log, to be
+        replayed by the next store opened.
+        """
+        self.maybeCheckpoint()
+        self.wal.close()
+        self.lock.close()
+
+    def maybeCheckpoint(self):
+        """Checkpoint if enough events or time have piled up."""
+        if self.pending >= self.checkpoint_events or (self.pending and
+                time.time() - self.last_checkpoint >
+                self.checkpoint_interval):
+            self.checkpoint()
+
+    def checkpoint(self):
+        """
+        Save the full training data, tagged with the last event it
+        includes, then empty the log.  A crash between the two just
+        leaves events in the log that will be skipped on replay.
+        """
+        tmp_fn = self.data_fn + TMP_SUFFIX
+        self.guesser.save(tmp_fn)
+        fout = open(tmp_fn, 'ab')
+        fout.write(struct.pack(TRAILER_FORMAT, TRAILER_MAGIC, self.seq))
+        fout.flush()
+        os.fsync(fout.fileno())
+        fout.close()
+        os.rename(tmp_fn, self.data_fn)
+
+        self.wal.close()
+        self.wal = open(self.wal_fn, 'wb')
+        self.saved_seq       = self.seq
+        self.pending         = 0
+        self.last_checkpoint = time.time()
+
+    def _apply(self, op, pool, text, log=False):
+        """Apply a training event to the guesser, logging it first."""
+        if log:
+            self.seq += 1
+            pickle.dump((self.seq, op, pool, text), self.wal,
+                        pickle.HIGHEST_PROTOCOL)
+            self.wal.flush()
+            os.fsync(self.wal.fileno())
+        getattr(self.guesser, op)(pool, text)
+        self.pending += 1
+        if log: self.maybeCheckpoint()
+
+    def _replay(self):
+        """
+        Apply logged events newer than the saved data.  A log cut short
+        by a crash is truncated after its last complete event.
+        """
+        try:
+            fin = open(self.wal_fn, 'r+b')
+        except IOError:
+            return
+        good = 0
+        while True:
+            try:
+                seq, op, pool, text = pickle.load(fin)
+            except (EOFError, ValueError, TypeError, IndexError,
+                    pickle.UnpicklingError):
+                break
+            good = fin.tell()
+            if seq > self.saved_seq:
+                self._apply(op, pool, text)
+                self.seq = seq
+        fin.truncate(good)
+        fin.close()
+
+def lockFile(lock_fn, timeout=LOCK_TIMEOUT):
+    """
+    Open and exclusively lock a lock file, waiting up to timeout seconds
+    for another process to release it, and return the open file.  The
+    lock lasts until the file is closed.
+    """
+    fout  = open(lock_fn, 'a')
+    start = time.time()
+    while True:
+        try:
+            fcntl.flock(fout.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return fout
+        except IOError:
+            if time.time() - start > timeout:
+                fout.close()
+                raise IOError("Timed out waiting for lock on %s" % lock_fn)
+            time.sleep(0.1)
+
+def readTrailer(data_fn):
+    """
+    Return the last logged event included in saved training data, or 0
+    for data saved without a trailer.
+    """
+    fin = open(data_fn, 'rb')
+    try:
+        fin.seek(0, 2)
+        if fin.tell() < TRAILER_SIZE: return 0
+        fin.seek(-TRAILER_SIZE, 2)
+        magic, seq = struct.unpack(TRAILER_FORMAT, fin.read(TRAILER_SIZE))
+        return (magic == TRAILER_MAGIC) and seq or 0
+    finally:
+        fin.close()
+
+def serveClassifier(store, host=SERVER_HOST, port=SERVER_PORT):
+    """
+    Serve a ClassifierStore over XML-RPC, checkpointing as needed
+    between requests.  Requests are handled one at a time, so the store
+    needs no locking.
+    """
+    server = SimpleXMLRPCServer((host, port), logRequests=False,
+                                allow_none=True)
+    server.timeout = 1.0
+    server.register_function(lambda: True, 'ping')
+    server.register_function(store.train, 'train')
+    server.register_function(store.untrain, 'untrain')
+    server.register_function(store.guess, 'guess')
+    server.register_function(store.guessMany, 'guessMany')
+    server.register_function(store.checkpoint, 'checkpoint')
+    while True:
+        server.handle_request()
+        store.maybeCheckpoint()
+
+class TimeoutTransport(xmlrpclib.Transport):
+    """XML-RPC transport with a socket timeout."""
+    def __init__(self, timeout=CLIENT_TIMEOUT):
+        """Initialize with the timeout in seconds."""
+        xmlrpclib.Transport.__init__(self)
+        self.timeout = timeout
+
+    def make_connection(self, host):
+        """Return a connection which will use the timeout."""
+        conn = xmlrpclib.Transport.make_connection(self, host)
+        conn.timeout = self.timeout
+        return conn
+
+class RemoteGuesser:
+    """
+    Client for the classifier server, supporting the train, untrain,
+    guess and save methods of a Bayes guesser.
+    """
+    def __init__(self, url=SERVER_URL, timeout=CLIENT_TIMEOUT):
+        """Initialize with the server URL."""
+        self.server = xmlrpclib.ServerProxy(url, TimeoutTransport(timeout),
+                                            allow_none=True)
+
+    def ping(self):
+        """Raise socket.error if the server isn't there."""
+        self.server.ping()
+
+    def train(self, pool, text):
+        """Train the guesser with text for a pool."""
+        self.server.train(pool, text)
+
+    def untrain(self, pool, text):
+        """Untrain the guesser with text for a pool."""
+        self.server.untrain(pool, text)
+
+    def guess(self, text):
+        """Return a list of (pool, probability) guesses for text."""
+        return [ tuple(x) for x in self.server.guess(text) ]
+
+    def guessMany(self, texts):
+        """Return a list of guesses for each of a list of texts."""
+        return [ [ tuple(x) for x in guess ]
+                 for guess in self.server.guessMany(texts) ]
+
+    def save(self, data_fn=None):
+        """Nothing to do, since the server logs and saves training."""
+        pass
+
+    def close(self):
+        """Nothing to close."""
+        pass
+
+def openGuesser(data_fn=BAYES_DATA_FN, url=SERVER_URL):
+    """
+    Return a RemoteGuesser if the classifier server is running and 
+    answering, or else a local ClassifierStore on the training data 
+    file.  Any failure to get a sane answer to a ping, from a refused
+    connection to a fault or a garbled response, means falling back.
+    """
+    guesser = RemoteGuesser(url)
+    try:
+        guesser.ping()
+        return guesser
+    except (socket.error, xmlrpclib.Error, httplib.HTTPException,
+            ExpatError, UnicodeError):
+        return ClassifierStore(data_fn)
+
+if __name__ == '__main__': main()
@@ -14,13 +14,15 @@ SITE_NAME    = "0xDECAFBAD"
 ERROR_LOG    = "www/www.decafbad.com/logs/error.log" 
 FEED_NAME_FN = "www/www.decafbad.com/docs/private-feeds/errors.%s"
 FEED_DIR     = "error_feed"
+RING_SLOTS   = 50
+SLOT_SIZE    = 64 * 1024
 
 def main():
     """
     Report new errors found in Apache logs.
     """
     # Construct the feed generator
-    f = LogBufferFeed(FEED_DIR)
+    f = LogBufferFeed(FEED_DIR, RING_SLOTS, SLOT_SIZE)
     f.MAX_AGE = 24 * 60 * 60 # 1 day
     f.FEED_META['feed.title']   = '%s Apache Errors' % SITE_NAME
     f.FEED_META['feed.tagline'] = \
@@ -45,7 +47,6 @@ def main():
         f.append_entry(entry)
 
     # Output the current feed entries as both RSS and Atom
-    open(FEED_NAME_FN % 'rss', 'w').write(f.scrape_rss())
-    open(FEED_NAME_FN % 'atom', 'w').write(f.scrape_atom())
+    f.scrape_many(('atom', 'rss'), FEED_NAME_FN)
 
 if __name__ == '__main__': main()
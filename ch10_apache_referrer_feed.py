@@ -5,17 +5,22 @@ ch10_apache_referrer_feed.py
 Scan the Apache access log for new referring links, build 
 mini-reports in feed entries.
 """
-import sys, os, re, shelve
+import sys, os, shelve
+import apachelib, filterlib
 from scraperlib import FeedEntryDict
 from monitorfeedlib import LogBufferFeed
-from ch10_bookmark_tailgrep import bookmark_tailgrep
+from ch10_bookmark_tailgrep import bookmark_tailgrep_iter
 
 SITE_NAME    = "0xDECAFBAD"
 SITE_ROOT    = "http://www.decafbad.com"
 ACCESS_LOG   = "www/www.decafbad.com/logs/access.log" 
 FEED_NAME_FN = "www/www.decafbad.com/docs/private-feeds/referrers.%s"
 FEED_DIR     = "referrer_feed"
+RING_SLOTS   = 50
+SLOT_SIZE    = 64 * 1024
 REFER_SEEN   = "%s/referrer_seen" % FEED_DIR
+EXCLUDE_HITS = "%s/exclusion_hits.txt" % FEED_DIR
+EXCLUDE_FN   = "referrer_exclude.conf"
 
 EXCLUDE_EXACT = {
     'referrer' : [ '', '-' ],
@@ -32,6 +37,13 @@ EXCLUDE_PARTIAL = {
     'path'     : [ '/images/', '.rss', '.rdf', '.xml' ]
 }
 
+# Exclusion rules come from the config file if there is one, falling
+# back to the lists above.
+if os.path.exists(EXCLUDE_FN):
+    EXCLUSIONS = filterlib.loadFilter(EXCLUDE_FN)
+else:
+    EXCLUSIONS = filterlib.RuleFilter(EXCLUDE_EXACT, EXCLUDE_PARTIAL)
+
 SUMMARY_TMPL = """
     <p>Found %(count)s new referring links:</p>
     %(links)s
@@ -55,25 +67,30 @@ def main():
     Scan Apache log and report new referrers found.
     """
     # Construct the feed generator
-    f = LogBufferFeed(FEED_DIR)
+    f = LogBufferFeed(FEED_DIR, RING_SLOTS, SLOT_SIZE)
     f.MAX_AGE = 24 * 60 * 60 # 1 day
     f.FEED_META['feed.title']   = '%s Referrering Links' % SITE_NAME
     f.FEED_META['feed.tagline'] = \
         'New referring links from Apache access.log on %s' % SITE_NAME
     
     # Load up tail of access log, parse, and filter
-    new_lines  = bookmark_tailgrep(ACCESS_LOG, max_initial_lines=100000)
-    all_events = parse_access_log(new_lines)
-    events     = [ x for x in all_events if event_filter(x) ]
+    new_lines  = bookmark_tailgrep_iter(ACCESS_LOG, max_initial_lines=100000)
+    cols       = apachelib.parse_access_log(new_lines, ('referrer', 'path'))
+    mask       = apachelib.exclusion_mask(cols, EXCLUSIONS)
+    pairs      = apachelib.count_pairs(cols, 'referrer', 'path', mask)
+
+    # Report how often each exclusion rule fired in this run, to help
+    # with pruning the rules.
+    open(EXCLUDE_HITS, 'w').write(filterlib.formatHits(EXCLUSIONS))
     
-    # Scan through latest events for new referrers
+    # Scan through latest referrer -> path pairs for new referrers
     referrers_seen = shelve.open(REFER_SEEN)
     new_referrers  = []
-    for evt in events:
-        k = '%(referrer)s -> %(path)s' % evt
+    for (referrer, path), count in pairs:
+        k = '%s -> %s' % (referrer, path)
         if not referrers_seen.has_key(k):
             referrers_seen[k] = 1
-            new_referrers.append( (evt['referrer'], evt['path']) )
+            new_referrers.append( (referrer, path) )
     referrers_seen.close()
     
     # If there were new referrers found, insert a new entry.
@@ -104,41 +121,6 @@ def main():
         f.append_entry(entry)
 
     # Output the current feed entries as both RSS and Atom
-    open(FEED_NAME_FN % 'rss', 'w').write(f.scrape_rss())
-    open(FEED_NAME_FN % 'atom', 'w').write(f.scrape_atom())
-
-def event_filter(event):
-    """Filter events on exact and partial exclusion criteria"""
-    for field, blst in EXCLUDE_PARTIAL.items():
-        ev_val = event[field]
-        for bl_val in blst:
-            if ev_val.find(bl_val) != -1: return False
-    
-    for field, blst in EXCLUDE_EXACT.items():
-        ev_val = event[field]
-        for bl_val in blst:
-            if ev_val == bl_val: return False
-    
-    return True
-
-ACCESS_RE = re.compile(\
-    '(?P<client_ip>\d+\.\d+\.\d+\.\d+) '
-    '(?P<ident>-|\w*) '
-    '(?P<user>-|\w*) '
-    '\[(?P<date>[^\[\]:]+):'
-    '(?P<time>\d+:\d+:\d+) '
-    '(?P<tz>.\d\d\d\d)\] '
-    '"(?P<method>[^ ]+) '
-    '(?P<path>[^ ]+) '
-    '(?P<proto>[^"]+)" '
-    '(?P<status>\d+) (?P<length>-|\d+) '
-    '"(?P<referrer>[^"]*)" '
-    '(?P<user_agent>".*")\s*\Z'
-)
-
-def parse_access_log(log_lines):
-    """Parse Apache log file lines via regex"""
-    matches = [ ACCESS_RE.search(y) for y in log_lines ]
-    return [ x.groupdict() for x in matches if x is not None ]
+    f.scrape_many(('atom', 'rss'), FEED_NAME_FN)
 
 if __name__ == '__main__': main()
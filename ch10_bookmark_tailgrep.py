@@ -4,7 +4,12 @@ ch10_bookmark_tailgrep.py
 
 Stateful tail, remembers where it left off reading.
 """
-import sys, os, re, shelve
+import sys, os, re, shelve, md5
+
+# Size of blocks read when scanning backward from the end of a file,
+# and the most of a file's first line used to fingerprint it.
+BLOCK_SIZE      = 64 * 1024
+FINGERPRINT_LEN = 1024
 
 def main():
     """
@@ -16,47 +21,131 @@ def main():
     if len(sys.argv) > 2:
         pattern  = re.compile(sys.argv[2])
         pattern_filter = lambda x: ( pattern.match(x) is not None )
-        new_lines = bookmark_tailgrep(filename, pattern_filter)
+        new_lines = bookmark_tailgrep_iter(filename, pattern_filter)
     else:
-        new_lines = bookmark_tailgrep(filename)
+        new_lines = bookmark_tailgrep_iter(filename)
     
-    sys.stdout.write("".join(new_lines))
+    for line in new_lines:
+        sys.stdout.write(line)
     
 class BookmarkInvalidException(Exception): pass
 
 def bookmark_tailgrep(tail_fn, line_filter=lambda x: True, 
         state_fn="tail_bookmarks", max_initial_lines=50):
     """
-    Stateful file tail reader which keeps a line number bookmark of 
-    where it last left off for a given filename.
+    Stateful file tail reader which keeps a bookmark of where it last 
+    left off for a given filename.  Returns a list of the new lines.
     """
-    fin      = open(tail_fn, 'r')
-    state    = shelve.open(state_fn)
-    last_num = state.get(tail_fn, 0)
-    
+    return list(bookmark_tailgrep_iter(tail_fn, line_filter, 
+        state_fn, max_initial_lines))
+
+def bookmark_tailgrep_iter(tail_fn, line_filter=lambda x: True, 
+        state_fn="tail_bookmarks", max_initial_lines=50):
+    """
+    Stateful file tail reader which keeps a byte offset bookmark of 
+    where it last left off for a given filename, and yields new lines 
+    as they're read.  The bookmark is only advanced once all the new 
+    lines have been read, but the state is closed even if the caller
+    stops early.
+    """
+    fin   = open(tail_fn, 'rb')
+    state = shelve.open(state_fn)
     try:
-        # Fast foward through file to bookmark.
-        for idx in range(last_num):
+        stat = os.fstat(fin.fileno())
+    
+        try:
+            # Seek straight to the bookmark, if it's still good.
+            offset = find_bookmark(fin, stat, state.get(tail_fn, None))
+            
+        except BookmarkInvalidException:
+            # In case of invalid bookmark, start from the tail-end of 
+            # the file.
+            offset = tail_offset(fin, stat.st_size, max_initial_lines)
+        
+        # Pass the new lines through the given line filter, stopping at
+        # EOF or at a partial line still being written.
+        fin.seek(offset)
+        while True:
+            line = fin.readline()
+            if not line.endswith('\n'): break
+            offset += len(line)
+            if line_filter(line): yield line
+        
+        # Advance the bookmark.
+        state[tail_fn] = {
+            'offset'     : offset,
+            'inode'      : stat.st_ino,
+            'size'       : stat.st_size,
+            'first_line' : fingerprint(fin)
+        }
+    finally:
+        state.close()
+        fin.close()
+
+def find_bookmark(fin, stat, bookmark):
+    """
+    Given an open file, its stat, and a bookmark, return the byte offset 
+    at which to resume reading.  Raises BookmarkInvalidException if the 
+    file has been rotated, truncated, or replaced since the bookmark.
+    """
+    if not bookmark:
+        raise BookmarkInvalidException
+
+    # Older bookmarks were line numbers, so fast foward through the file
+    # to find the offset one last time.
+    if type(bookmark) is int:
+        for idx in range(bookmark):
             # If EOF hit before bookmark, it's become invalid.
             if fin.readline() == '': 
                 raise BookmarkInvalidException
-    
-    except BookmarkInvalidException:
-        # In case of invalid bookmark, rewind to start of file.
-        last_num = 0
-        fin.seek(0)
-    
-    # Grab the rest of the lines in the file as new.
-    new_lines = fin.readlines()
-    
-    # Advance the bookmark index.
-    state[tail_fn] = last_num + len(new_lines)
+        return fin.tell()
+
+    # A new inode means the log was rotated, and a file shorter than the
+    # bookmark means it was truncated.  A different first line catches 
+    # truncation followed by enough writing to pass the old offset, 
+    # though only if the first line was complete when bookmarked.
+    if bookmark['inode'] != stat.st_ino or \
+            bookmark['offset'] > stat.st_size:
+        raise BookmarkInvalidException
+    if bookmark['first_line'] is not None and \
+            bookmark['first_line'] != fingerprint(fin):
+        raise BookmarkInvalidException
+
+    return bookmark['offset']
+
+def fingerprint(fin):
+    """
+    Return a hash of the start of a file's first line, or None if the 
+    first line is short and still being written.
+    """
+    fin.seek(0)
+    line = fin.readline(FINGERPRINT_LEN)
+    if len(line) < FINGERPRINT_LEN and not line.endswith('\n'):
+        return None
+    return md5.md5(line).hexdigest()
+
+def tail_offset(fin, size, num_lines):
+    """
+    Return the byte offset of the start of the last num_lines complete
+    lines in a file, scanning backward from the end in blocks.
+    """
+    pos, count = size, 0
+    while pos > 0:
+        read_size = min(BLOCK_SIZE, pos)
+        pos -= read_size
+        fin.seek(pos)
+        block = fin.read(read_size)
 
-    # If rewound to beginning of file, limit to the tail-end.
-    if last_num == 0:
-        new_lines = new_lines[-max_initial_lines:]
+        # Count newlines back from the end of the block.  The line after
+        # the (num_lines+1)th newline from the end starts the tail.
+        idx = len(block)
+        while True:
+            idx = block.rfind('\n', 0, idx)
+            if idx == -1: break
+            count += 1
+            if count > num_lines: 
+                return pos + idx + 1
     
-    # Pass the new lines through the given line filter
-    return [ x for x in new_lines if line_filter(x) ]
+    return 0
 
 if __name__ == '__main__': main()
@@ -76,7 +76,6 @@ def main():
     gzip.open(old_output_fn, "w").write("".join(new_lines))
 
     # Output the current feed entries as both RSS and Atom
-    open(FEED_NAME_FN % 'rss', 'w').write(f.scrape_rss())
-    open(FEED_NAME_FN % 'atom', 'w').write(f.scrape_atom())
+    f.scrape_many(('atom', 'rss'), FEED_NAME_FN)
 
 if __name__ == '__main__': main()
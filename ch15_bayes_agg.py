@@ -4,16 +4,20 @@ ch15_bayes_agg.py
 Bayes-enabled feed aggregator
 """
 import sys, time, md5, urllib
-import feedparser
+from httpcache import HTTPCache
+from feedcache import parseContent
 from agglib import UNICODE_ENC, EntryWrapper, openDBs, closeDBs
 from agglib import getNewFeedEntries, writeAggregatorPage
-from reverend.thomas import Bayes
+from bayeslib import openGuesser
+from sqlitelib import sqlite3
 
 FEEDS_FN        = "bayes_feeds.txt"
 FEED_DB_FN      = "bayes_feeds_db"
 ENTRY_DB_FN     = "bayes_entry_seen_db"
 HTML_FN         = "bayes-agg-%Y%m%d-%H%M%S.html"
 BAYES_DATA_FN   = "bayesdata.dat"
+ENTRY_INDEX_FN  = "bayes_entry_index.db"
+ENTRY_INDEX_AGE = 30 * 24 * 60 * 60
 ENTRY_UNIQ_KEYS = ('title', 'link', 'issued', 
                    'modified', 'description')
 
@@ -21,64 +25,76 @@ def main():
     """
     Build aggregator report pages with Bayes rating links.
     """
-    # Create a new Bayes guesser
-    guesser = Bayes()
-
-    # Attempt to load Bayes data, ignoring IOError on first run.
-    try: guesser.load(BAYES_DATA_FN)
-    except IOError: pass
-    
     # Open up the databases, load the subscriptions, get new entries.
     feed_db, entry_db = openDBs(FEED_DB_FN, ENTRY_DB_FN)
     feeds   = [ x.strip() for x in open(FEEDS_FN, "r").readlines() ]
     entries = getNewFeedEntries(feeds, feed_db, entry_db)
     
-    # Score the new entries using the Bayesian guesser
+    # Score the new entries using the Bayesian guesser.  The guesser is
+    # only opened once polling is done, since a local one locks the 
+    # training data against CGI clicks until it's closed.
+    guesser = openGuesser(BAYES_DATA_FN)
     entries = scoreEntries(guesser, entries)
+    guesser.close()
 
     # Write out the current run's aggregator report.
     out_fn  = time.strftime(HTML_FN)
     writeAggregatorPage(entries, out_fn, DATE_HDR_TMPL, FEED_HDR_TMPL, 
         ENTRY_TMPL, PAGE_TMPL)
+
+    # Index the entries linked from the report, for training later.
+    index = EntryIndex()
+    index.addEntries(entries)
+    index.prune()
+    index.close()
     
-    # Close the databases and save the current guesser's state to disk.
+    # Close the databases.
     closeDBs(feed_db, entry_db)
-    guesser.save(BAYES_DATA_FN)
     
 class ScoredEntryWrapper(EntryWrapper):
     """
     Tweak the EntryWrapper class to include a score for the entry.
     """
+    __slots__ = ('score', 'id')
+
     def __init__(self, data, entry, score=0.0): 
         EntryWrapper.__init__(self, data, entry)
         self.score = score
         self.id    = makeEntryID(entry)
     
-    def __getitem__(self, name):
+    def getField(self, name):
         """
         Include the entry score & id in template output options.
         """
         # Allow prefix for URL quoting
         if name.startswith("url:"):
-            return urllib.quote(self.__getitem__(name[4:]))
+            return urllib.quote(self[name[4:]])
         
         if name == 'id':          return self.id
         if name == 'feed.url':    return self.data.url
         if name == 'entry.score': return self.score
-        return EntryWrapper.__getitem__(self, name)
+        return EntryWrapper.getField(self, name)
 
 def scoreEntries(guesser, entries):
     """
     Return a list of entries modified to include scores.
     """
-    return [ ScoredEntryWrapper(e.data, e.entry, scoreEntry(guesser, e))
-             for e in entries ]
+    guesses = guessEntries(guesser, entries)
+    return [ ScoredEntryWrapper(e.data, e.entry, scoreGuess(g))
+             for e, g in zip(entries, guesses) ]
             
 def scoreEntry(guesser, e):
     """
     Score an entry, assuming like and dislike classifications.
     """
-    guess = dict( guessEntry(guesser, e) )
+    return scoreGuess(guessEntry(guesser, e))
+
+def scoreGuess(guess):
+    """
+    Score a classification guess, assuming like and dislike 
+    classifications.
+    """
+    guess = dict(guess)
     return guess.get('like', 0) - guess.get('dislike', 0)
     
 def trainEntry(guesser, pool, e):
@@ -95,10 +111,22 @@ def guessEntry(guesser, e):
     content = summarizeEntry(e)
     return guesser.guess(content)
 
+def guessEntries(guesser, entries):
+    """
+    Make classification guesses for a list of entries, all in one batch
+    if the guesser supports it.
+    """
+    contents = [ summarizeEntry(e) for e in entries ]
+    if hasattr(guesser, 'guessMany'):
+        return guesser.guessMany(contents)
+    return [ guesser.guess(x) for x in contents ]
+
 def summarizeEntry(e):
     """
     Summarize entry content for use with the Bayes guesser.
     """
+    # Indexed entries were summarized when they were indexed.
+    if isinstance(e, IndexedEntry): return e.content
     # Include the feed title
     content = [ e.data.feed.title ]
     # Include the entry title and summary
@@ -111,13 +139,104 @@ def summarizeEntry(e):
 def findEntry(feed_uri, entry_id):
     """
     Attempt to locate a feed entry, given the feed URI and an entry ID.
+    Entries indexed by the aggregator are found without fetching the 
+    feed at all.
     """
-    feed_data = feedparser.parse(feed_uri)
+    index = EntryIndex()
+    try:
+        entry = index.getEntry(feed_uri, entry_id)
+    finally:
+        index.close()
+    if entry is not None: return entry
+
+    feed_data = parseContent(HTTPCache(feed_uri).content())
     for entry in feed_data.entries:
         if makeEntryID(entry) == entry_id:
             return ScoredEntryWrapper(feed_data, entry, 0.0)
     return None
 
+class IndexedEntry:
+    """
+    Entry found in the EntryIndex, with just enough of a 
+    ScoredEntryWrapper's fields for training.
+    """
+    def __init__(self, feed_uri, entry_id, feed_title, entry_title, 
+            content):
+        """Initialize with the indexed entry details."""
+        self.id      = entry_id
+        self.content = content
+        self.fields  = {
+            'feed.uri'    : feed_uri,
+            'feed.url'    : feed_uri,
+            'feed.title'  : feed_title,
+            'entry.title' : entry_title,
+            'id'          : entry_id
+        }
+
+    def __getitem__(self, name):
+        """Return a field value, or an empty string."""
+        return self.fields.get(name, '')
+
+class EntryIndex:
+    """
+    SQLite index of entries found by the aggregator, keyed by feed URI
+    and entry ID, holding titles and the summarized entry text.
+    """
+    def __init__(self, index_fn=ENTRY_INDEX_FN):
+        """Open the index, creating the table if necessary."""
+        if sqlite3 is None:
+            raise ImportError("EntryIndex requires sqlite3 or pysqlite2")
+        self.conn = sqlite3.connect(index_fn)
+        self.conn.text_factory = str
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS entries (
+                feed_uri    TEXT,
+                entry_id    TEXT,
+                feed_title  TEXT,
+                entry_title TEXT,
+                content     TEXT,
+                indexed     REAL,
+                PRIMARY KEY (feed_uri, entry_id)
+            )""")
+        self.conn.execute("""
+            CREATE INDEX IF NOT EXISTS entries_indexed ON entries (indexed)
+        """)
+        self.conn.commit()
+
+    def addEntries(self, entries):
+        """Index a list of ScoredEntryWrappers, all in one transaction."""
+        now = time.time()
+        self.conn.executemany("""
+            INSERT OR REPLACE INTO entries 
+                (feed_uri, entry_id, feed_title, entry_title, content, 
+                 indexed)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, [ (e['feed.url'], e.id, e['feed.title'], e['entry.title'],
+                summarizeEntry(e).encode(UNICODE_ENC), now) 
+               for e in entries ])
+        self.conn.commit()
+
+    def getEntry(self, feed_uri, entry_id):
+        """Return an IndexedEntry, or None if the entry isn't indexed."""
+        row = self.conn.execute("""
+            SELECT feed_title, entry_title, content FROM entries 
+            WHERE feed_uri = ? AND entry_id = ?
+        """, (feed_uri, entry_id)).fetchone()
+        if row is None: return None
+        feed_title, entry_title, content = row
+        return IndexedEntry(feed_uri, entry_id, feed_title, entry_title,
+                            content.decode(UNICODE_ENC))
+
+    def prune(self, max_age=ENTRY_INDEX_AGE):
+        """Forget entries indexed longer ago than the maximum age."""
+        self.conn.execute("DELETE FROM entries WHERE indexed < ?",
+                          (time.time() - max_age,))
+        self.conn.commit()
+
+    def close(self):
+        """Close the index."""
+        self.conn.close()
+
 def makeEntryID(entry):
     """Find a unique identifier for a given entry."""
     if entry.has_key('id'):
@@ -9,7 +9,7 @@ import sys, os, time, ch15_bayes_agg
 from agglib import openDBs, closeDBs, getNewFeedEntries
 from scraperlib import Scraper
 from ch14_feed_normalizer import normalize_feed_meta, normalize_entries
-from reverend.thomas import Bayes
+from bayeslib import openGuesser
 
 FEED_TITLE    = 'Bayes Recommendations'
 FEED_TAGLINE  = 'Entries recommended by Bayesian-derived ratings'
@@ -23,25 +23,26 @@ def main():
     """
     Perform a test run of the FeedFilter using defaults.
     """
-    # Create a new Bayes guesser, attempt to load data
-    guesser = Bayes()
-    guesser.load(BAYES_DATA_FN)
-    
     # Open up the databases, load the subscriptions, get new entries.
     feed_db, entry_db = openDBs(FEED_DB_FN, ENTRY_DB_FN)
     feeds   = [ x.strip() for x in open(FEEDS_FN, "r").readlines() ]
     entries = getNewFeedEntries(feeds, feed_db, entry_db)
     
+    # Connect to the classifier server, or load up Bayes data locally.
+    # This waits until polling is done, since a local guesser locks the
+    # training data against CGI clicks until it's closed.
+    guesser = openGuesser(BAYES_DATA_FN)
+
     # Build the feed filter.
     f = BayesFilter(guesser, entries)
     f.FEED_META['feed.title']   = FEED_TITLE
     f.FEED_META['feed.tagline'] = FEED_TAGLINE
     
     # Output the feed as both RSS and Atom.
-    open(FEED_NAME_FN % 'rss', 'w').write(f.scrape_rss())
-    open(FEED_NAME_FN % 'atom', 'w').write(f.scrape_atom())
+    f.scrape_many(('atom', 'rss'), FEED_NAME_FN)
+    guesser.close()
     
-    # Close the databases and save the current guesser's state to disk.
+    # Close the databases.
     closeDBs(feed_db, entry_db)
     
 class BayesFilter(Scraper):
@@ -83,8 +84,9 @@ class BayesFilter(Scraper):
         """
         # Now, get a score for each entry and, for each entry scored
         # above the minimum threshold, include it in the entries for output.
-        for e in self.entries:
-            score = ch15_bayes_agg.scoreEntry(self.guesser, e)
+        guesses = ch15_bayes_agg.guessEntries(self.guesser, self.entries)
+        for e, guess in zip(self.entries, guesses):
+            score = ch15_bayes_agg.scoreGuess(guess)
             if score > self.min_score:
                 # HACK: Tweak each entry's title to include the score.
                 e.entry['title'] = u"(%0.3f) %s" % \
@@ -10,7 +10,7 @@ import cgitb; cgitb.enable()
 
 from ch15_bayes_agg import ScoredEntryWrapper, findEntry
 from ch15_bayes_agg import guessEntry, scoreEntry, trainEntry
-from reverend.thomas import Bayes
+from bayeslib import openGuesser
 
 BAYES_DATA_FN = "bayesdata.dat"
 
@@ -24,9 +24,8 @@ def main():
     entry_id = form.getvalue('entry')
     like     = ( form.getvalue('like')=='1' ) and 'like' or 'dislike'
 
-    # Create a new Bayes guesser, attempt to load data
-    guesser = Bayes()
-    guesser.load(BAYES_DATA_FN)
+    # Connect to the classifier server, or load up Bayes data locally.
+    guesser = openGuesser(BAYES_DATA_FN)
 
     # Use the aggregator to find the given entry.
     entry = findEntry(feed_uri, entry_id)
@@ -42,16 +41,13 @@ def main():
         before_guess = guessEntry(guesser, entry)
         before_score = scoreEntry(guesser, entry)
 
-        # Train with this entry and classification, save the data.
+        # Train with this entry and classification.
         trainEntry(guesser, like, entry)
         
         # Take a sample guess after training.
         after_guess = guessEntry(guesser, entry)
         after_score = scoreEntry(guesser, entry)
 
-        # Save the guesser data
-        guesser.save(BAYES_DATA_FN)
-        
         # Report the results.
         print """
         <html>
@@ -101,4 +97,8 @@ def main():
             'entry.id'     : entry_id,
         }
 
+    # Done with the guesser.  Training is logged as it happens, and the
+    # full data only saved at checkpoints, not on every click.
+    guesser.close()
+
 if __name__=='__main__': main()
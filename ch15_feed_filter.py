@@ -6,6 +6,7 @@ Build a new feed out of entries filtered from a source feed.
 """
 import sys, re, feedparser
 from scraperlib import FeedEntryDict, Scraper
+from filterlib import RuleFilter
 from ch14_feed_normalizer import normalize_feed_meta, normalize_entries
 
 FEED_NAME_FN = "www/www.decafbad.com/docs/private-feeds/filtered.%s"
@@ -23,8 +24,7 @@ def main():
     f.STATE_FN = 'filter_state'
     
     # Output the feed as both RSS and Atom.
-    open(FEED_NAME_FN % 'rss', 'w').write(f.scrape_rss())
-    open(FEED_NAME_FN % 'atom', 'w').write(f.scrape_atom())
+    f.scrape_many(('atom', 'rss'), FEED_NAME_FN)
     
 class FeedFilter(Scraper):
     """
@@ -35,11 +35,10 @@ class FeedFilter(Scraper):
         # Stow the feed URI and cache
         self.feed_uri   = feed_uri
 
-        # Pre-compile all regexes
-        self.filter_re = {}
-        for k,v in filter_re.items():
-            self.filter_re[k] = re.compile(v, 
-                re.DOTALL | re.MULTILINE | re.IGNORECASE)
+        # Pre-compile all regexes.  Each field may have a single regex
+        # or a list of them, any of which can match.
+        self.filter_re = RuleFilter(regex=filter_re, 
+            flags=re.DOTALL | re.MULTILINE | re.IGNORECASE)
 
     def produce_entries(self):
         """
@@ -52,22 +51,10 @@ class FeedFilter(Scraper):
         # Build the output feed's normalized metadata
         self.FEED_META = normalize_feed_meta(feed_data, self.date_fmt)
         
-        # Now, apply the regex map to filter each incoming entry.
-        entries_filtered = []
-        for entry in feed_data.entries:
-            # Initially assume the entry is okay for inclusion.
-            ok_include = True
-            
-            # Iterate through each entry key and regex pair.
-            for k,r in self.filter_re.items():
-                # The first time a field of the entry fails to match
-                # the regex map criteria, reject it for inclusion.
-                if not (entry.has_key(k) and r.match(entry[k])):
-                    ok_include = False
-                    break
-            
-            # Finally, if the entry passes all the tests, include it.
-            if ok_include: entries_filtered.append(entry)
+        # Now, apply the regex map to filter each incoming entry,
+        # including only those where every field matches.
+        entries_filtered = [ entry for entry in feed_data.entries
+                             if self.filter_re.matchAll(entry) ]
                     
         # Normalize all the filtered entries
         entries = normalize_entries(entries_filtered)
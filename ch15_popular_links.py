@@ -152,8 +152,7 @@ def main():
     f.append_entry(entry)
     
     # Output the current feed entries as both RSS and Atom
-    open(FEED_NAME_FN % 'rss', 'w').write(f.scrape_rss())
-    open(FEED_NAME_FN % 'atom', 'w').write(f.scrape_atom())
+    f.scrape_many(('atom', 'rss'), FEED_NAME_FN)
     
 class LinkSkimmer(HTMLParser):
     """
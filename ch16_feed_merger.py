@@ -4,8 +4,9 @@ ch16_feed_merger.py
 
 Combine many feeds into a single normalized feed.
 """
-import sys, feedparser
+import sys
 from httpcache import HTTPCache
+from feedcache import parseContent
 from scraperlib import FeedEntryDict, Scraper
 from ch14_feed_normalizer import normalize_entries
 
@@ -51,7 +52,7 @@ class FeedMerger(Scraper):
         for feed_uri in self.feed_uris:
             
             # Grab and parse the feed
-            feed_data = feedparser.parse(HTTPCache(feed_uri).content())
+            feed_data = parseContent(HTTPCache(feed_uri).content())
             
             # Append the list of normalized entries onto merged list.
             curr_entries = normalize_entries(feed_data.entries)
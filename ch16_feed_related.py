@@ -4,9 +4,10 @@ ch16_feed_related.py
 
 Insert related links into a normalized feed.
 """
-import sys, urllib, feedparser, xmltramp
+import sys, urllib, xmltramp
 from xml.sax import SAXParseException
 from httpcache import HTTPCache
+from feedcache import parseContent
 from scraperlib import FeedEntryDict, Scraper
 from ch14_feed_normalizer import normalize_feed_meta, normalize_entries
 
@@ -62,7 +63,7 @@ class FeedRelator(Scraper):
         the lists together.
         """
         # Grab and parse the feed
-        feed = feedparser.parse(HTTPCache(self.main_feed).content())
+        feed = parseContent(HTTPCache(self.main_feed).content())
         
         # Normalize feed meta data
         self.FEED_META = normalize_feed_meta(feed, self.date_fmt)
@@ -5,8 +5,9 @@ ch17_feed_to_javascript.py
 Fetch and parse a feed, render it as JavaScript code suitable 
 for page include.
 """
-import sys, feedparser
+import sys
 from httpcache import HTTPCache
+from feedcache import parseContent
 from ch14_feed_normalizer import normalize_entries
 
 FEED_URL = "http://www.decafbad.com/blog/index.xml"
@@ -57,7 +58,7 @@ class JavaScriptFeed:
         """
         # Fetch and parse the feed
         cache     = HTTPCache(self.feed_url) 
-        feed_data = feedparser.parse(cache.content())
+        feed_data = parseContent(cache.content())
 
         # Build a list of content strings by populating entry template
         entries_out = [ self.ENTRY_TMPL % {
@@ -24,8 +24,7 @@ def main():
     f.STATE_FN = 'mod_event_feed_filter'
     
     # Output the current feed entries as both RSS and Atom
-    open(FEED_OUT_FN % 'rss', 'w').write(f.scrape_rss())
-    open(FEED_OUT_FN % 'atom', 'w').write(f.scrape_atom())
+    f.scrape_many(('atom', 'rss'), FEED_OUT_FN)
     
 class ModEventFeed(Scraper):
     """
@@ -4,8 +4,9 @@ downloaders.py
 
 Provides means to download content by URL.
 """
-import sys, os.path, urllib2, time
+import sys, os.path, time, rfc822
 from urlparse import urlparse
+from fetchlib import fetch, fetch_data, FetchError
 
 from threading import Event
 from BitTorrent.bencode import bdecode
@@ -27,6 +28,7 @@ class HTTPDownloader:
     PERC_STEP  = 10
     CHUNK_SIZE = 10*1024
     PROG_OUT   = sys.stdout
+    TMP_SUFFIX = ".part"
     
     def _print(self, msg):
         self.PROG_OUT.write(msg)
@@ -35,7 +37,10 @@ class HTTPDownloader:
     def downloadURL(self, dest_path, url):
         """
         Given a destination path and URL, download with a 
-        progress indicator.
+        progress indicator.  The download goes to a temporary file 
+        which only replaces the destination once it's complete, so a 
+        file at the destination path is always a whole download.
+        Raises IOError if the content comes up short.
         """
         files = []
         
@@ -46,13 +51,28 @@ class HTTPDownloader:
         files.append(fout_path)
         self._print("\t\t%s" % (url_fn))
         
-        # Open the file for writing, initialize size to 0.
-        fout      = open(fout_path, "w")
+        # Ask for the URL without compression, so the content length 
+        # tracks progress.  If the file's already been downloaded, only
+        # fetch it again if it's changed since.  Unfinished downloads 
+        # never get renamed into place, so don't count.
+        headers = { 'Accept-Encoding' : 'identity' }
+        if os.path.exists(fout_path):
+            headers['If-Modified-Since'] = \
+                rfc822.formatdate(os.path.getmtime(fout_path))
+        try:
+            fin = fetch(url, headers=headers)
+        except FetchError, e:
+            if e.status != 304: raise
+            self._print(" (not modified)\n")
+            return files
+
+        # Open the temporary file for writing, initialize size to 0.
+        tmp_path  = fout_path + self.TMP_SUFFIX
+        fout      = open(tmp_path, "wb")
         fout_size = 0
         
-        # Open the URL for reading, try getting the content length.
-        fin          = urllib2.urlopen(url)
-        fin_size_str = fin.headers.getheader("Content-Length", "-1")
+        # Try getting the content length.
+        fin_size_str = fin.headers.get("content-length", "-1")
         fin_size     = int(fin_size_str.split(";",1)[0])
         self._print(" (%s bytes): " % (fin_size))
         
@@ -60,25 +80,39 @@ class HTTPDownloader:
         perc_step, perc, next_perc = self.PERC_STEP, 0, 0
         perc_chunk = fin_size / (100/self.PERC_STEP) 
         
-        while True:
-            # Read in a chunk of data, breaking from loop if 
-            # no data returned
-            data = fin.read(self.CHUNK_SIZE)
-            if len(data) == 0: break
-            
-            # Write a chunk of data, incrementing output file size
-            fout.write(data)
-            fout_size += len(data)
-             
-            # If the current output size has exceeded the next
-            while fin_size > 0 and fout_size >= next_perc:
-                self._print("%s " % perc)
-                perc      += perc_step
-                next_perc += perc_chunk
+        try:
+            while True:
+                # Read in a chunk of data, breaking from loop if 
+                # no data returned
+                data = fin.read(self.CHUNK_SIZE)
+                if len(data) == 0: break
+                
+                # Write a chunk of data, incrementing output file size
+                fout.write(data)
+                fout_size += len(data)
+                 
+                # If the current output size has exceeded the next
+                while fin_size > 0 and fout_size >= next_perc:
+                    self._print("%s " % perc)
+                    perc      += perc_step
+                    next_perc += perc_chunk
             
-        # Close input & output, line break at the end of progress.
+            # A download cut short isn't kept.
+            if fin_size >= 0 and fout_size != fin_size:
+                raise IOError("Got %s of %s bytes" % (fout_size, fin_size))
+
+        except:
+            # Close input & output, throw away the partial download.
+            fout.close()
+            fin.close()
+            os.remove(tmp_path)
+            raise
+
+        # Close input & output, move the finished download into place,
+        # line break at the end of progress.
         fout.close()
         fin.close()
+        os.rename(tmp_path, fout_path)
         self._print("\n")
 
         return files
@@ -128,9 +162,7 @@ class BitTorrentDownloader:
         files to be downloaded, and total length of download.
         """
         # Grab the torrent metadata
-        metainfo_file = urllib2.urlopen(url)
-        metainfo = bdecode(metainfo_file.read())
-        metainfo_file.close()
+        metainfo = bdecode(fetch_data(url))
         
         # Gather the list of files in the torrent and total size.
         files = []
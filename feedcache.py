@@ -4,8 +4,10 @@ feedcache
 
 Implements a shared cache of feed data polled via feedparser.
 """
-import sys, os, os.path, md5, gzip, feedparser, time
+import sys, os, os.path, md5, gzip, feedparser, time, marshal
 import cPickle as pickle
+from pollsched import nextPoll
+from sqlitelib import sqlite3
 
 def main():
     """
@@ -24,12 +26,16 @@ class FeedCacheRecord:
     """
     Record stored in feed cache.
     """
-    def __init__(self, last_poll=0.0, etag='', modified=None, data=None):
+    def __init__(self, last_poll=0.0, etag='', modified=None, data=None,
+            next_poll=None, interval=None, history=None):
         """Initialize the cache record."""
         self.last_poll = last_poll
         self.etag      = etag
         self.modified  = modified
         self.data      = data
+        self.next_poll = next_poll
+        self.interval  = interval
+        self.history   = history or []
 
 class FeedCache:
     """
@@ -38,16 +44,15 @@ class FeedCache:
     CACHE_DIR      = ".feed_cache"
     REFRESH_PERIOD = 60 * 60
     
-    def __init__(self, cache_dir=CACHE_DIR, refresh_period=REFRESH_PERIOD):
+    def __init__(self, cache_dir=CACHE_DIR, refresh_period=REFRESH_PERIOD,
+            storage=None):
         """
-        Initialize and open the cache.
+        Initialize and open the cache.  Records are kept as pickle files
+        in cache_dir, unless some other storage is supplied.
         """
         self.refresh_period = refresh_period
         self.cache_dir      = cache_dir
-
-        # Create the cache dir, if it doesn't yet exist.
-        if not os.path.exists(cache_dir):
-            os.makedirs(cache_dir)
+        self.storage        = storage or PickleDirStorage(cache_dir)
             
     def parse(self, feed_uri, **kw):
         """
@@ -62,13 +67,19 @@ class FeedCache:
         """
         return self._loadRecord(feed_uri, None)
 
+    def close(self):
+        """
+        Close the cache storage.
+        """
+        self.storage.close()
+
     def refreshFeeds(self):
         """
-        Refresh all the feeds in the cache.
+        Refresh all the feeds in the cache which are due.
         """
-        # Load up the list of feed URIs, report how many feeds 
-        # in cache and start processing.
-        feed_uris  = self._getCachedURIs()
+        # Load up the list of feed URIs due for a refresh, and start 
+        # processing.
+        feed_uris  = self._getDueURIs()
         for feed_uri in feed_uris:
             try:
                 # Refresh the current feed URI
@@ -85,11 +96,16 @@ class FeedCache:
         Refresh a given feed.
         """
         # Get the record for this feed, creating a new one if necessary.
-        feed_rec = self._loadRecord(feed_uri, FeedCacheRecord())
+        # Parsed data isn't needed for the refresh, so storage which 
+        # keeps it apart from the rest of the record can skip loading it.
+        feed_rec = self._loadRecord(feed_uri, FeedCacheRecord(), False)
         
-        # Check to see whether it's time to refresh this feed yet.
-        # TODO: Respect/obey TTL, update schedule, cache control headers.
-        if (time.time() - feed_rec.last_poll) < self.refresh_period:
+        # Check to see whether it's time to refresh this feed yet, 
+        # falling back to the refresh period for records saved before
+        # the feed had a schedule.
+        next_poll = feed_rec.next_poll or \
+                    (feed_rec.last_poll + self.refresh_period)
+        if time.time() < next_poll:
             pass
         else:
             # Fetch the feed using the ETag and Last-Modified notes.
@@ -107,57 +123,385 @@ class FeedCache:
                 del feed_data['bozo_exception']
     
             # If the feed HTTP status is 304, there was no change.
-            if feed_data.get('status', -1) != 304:
+            changed = ( feed_data.get('status', -1) != 304 )
+            if changed:
                 feed_rec.etag     = feed_data.get('etag', '')
                 feed_rec.modified = feed_data.get('modified', None)
                 feed_rec.data     = feed_data
 
+            # Schedule the next refresh, using TTL, update schedule and
+            # cache control hints along with the feed's change history.
+            (feed_rec.next_poll, feed_rec.interval, feed_rec.history) = \
+                nextPoll(feed_data, changed, 
+                         feed_rec.interval or self.refresh_period,
+                         feed_rec.history)
+
             # Update the feed cache record.
             self._saveRecord(feed_uri, feed_rec)
     
     # Watch for subclassable parts below here.
     
-    def _recordFN(self, feed_uri):
+    def _getCachedURIs(self):
         """
-        Return the filename for a given feed URI.
+        Get a list of feed URIs in the cache.
         """
-        hash = md5.md5(feed_uri).hexdigest()
-        return os.path.join(self.cache_dir, '%s' % hash)
+        return self.storage.getURIs()
+    
+    def _getDueURIs(self):
+        """
+        Get a list of feed URIs in the cache due for a refresh.
+        """
+        return self.storage.getDueURIs(time.time(), self.refresh_period)
+    
+    def _loadRecord(self, feed_uri, default=None, with_data=True):
+        """
+        Load a FeedCacheRecord from storage.
+        """
+        return self.storage.load(feed_uri, default, with_data)
 
-    def _getCachedURIs(self):
+    def _saveRecord(self, feed_uri, record):
         """
-        Get a list of feed URIs in the cache.
+        Save a FeedCacheRecord to storage.
         """
-        uris = []
+        self.storage.save(feed_uri, record)
+
+class PickleDirStorage:
+    """
+    Stores each feed cache record as a pickle file in a directory.
+    """
+    def __init__(self, cache_dir):
+        """
+        Initialize the storage, creating the directory if necessary.
+        """
+        self.cache_dir = cache_dir
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def close(self):
+        """Nothing to close for pickle files."""
+        pass
+
+    def getURIs(self):
+        """
+        Get a list of feed URIs in the cache.  The filenames are only
+        hashes, so this has to load every record to find its URI.
+        """
+        return [ uri for uri, rec in self.getRecords() ]
+
+    def getDueURIs(self, now, refresh_period):
+        """
+        Get a list of feed URIs due for a refresh.
+        """
+        return [ uri for uri, rec in self.getRecords()
+                 if (rec.next_poll or 
+                     (rec.last_poll + refresh_period)) <= now ]
+
+    def getRecords(self):
+        """
+        Get a list of (uri, FeedCacheRecord) for all records which 
+        have feed data with a URI.
+        """
+        recs = []
         for fn in os.listdir(self.cache_dir):
             rec_fn = os.path.join(self.cache_dir, fn)
-            data   = pickle.load(open(rec_fn, 'rb'))
-            uri    = data['data'].get('url', None)
-            if uri: uris.append(uri)
-        return uris
-    
-    def _loadRecord(self, feed_uri, default=None):
+            rec    = FeedCacheRecord(**pickle.load(open(rec_fn, 'rb')))
+            uri    = (rec.data or {}).get('url', None)
+            if uri: recs.append( (uri, rec) )
+        return recs
+
+    def load(self, feed_uri, default=None, with_data=True):
         """
         Load a FeedCacheRecord from disk.
         """
         try:
-            rec_fn = self._recordFN(feed_uri)
+            rec_fn = self.recordFN(feed_uri)
             data   = pickle.load(open(rec_fn, 'rb'))
             return FeedCacheRecord(**data)
         except IOError:
             return default
 
-    def _saveRecord(self, feed_uri, record):
+    def save(self, feed_uri, record):
         """
         Save a FeedCacheRecord to disk.
         """
-        rec_fn = self._recordFN(feed_uri)
+        rec_fn = self.recordFN(feed_uri)
         pickle.dump(record.__dict__, open(rec_fn, 'wb'))
 
+    def recordFN(self, feed_uri):
+        """
+        Return the filename for a given feed URI.
+        """
+        hash = md5.md5(feed_uri).hexdigest()
+        return os.path.join(self.cache_dir, '%s' % hash)
+
+class SQLiteStorage:
+    """
+    Stores feed cache records in a single SQLite database.  The small
+    polling metadata lives in an indexed table apart from the parsed 
+    feed data, so finding due feeds never touches the big blobs.
+    """
+    DB_FN = ".feed_cache.db"
+
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS feeds (
+               uri       TEXT PRIMARY KEY,
+               last_poll REAL,
+               etag      TEXT,
+               modified  TEXT,
+               next_poll REAL,
+               interval  REAL,
+               history   TEXT
+           )""",
+        """CREATE INDEX IF NOT EXISTS feeds_next_poll 
+               ON feeds (next_poll)""",
+        """CREATE TABLE IF NOT EXISTS feed_data (
+               uri  TEXT PRIMARY KEY,
+               data BLOB
+           )""",
+    ]
+
+    def __init__(self, db_fn=DB_FN):
+        """
+        Initialize the storage, opening the database and creating the
+        tables if necessary.
+        """
+        if sqlite3 is None:
+            raise ImportError("SQLiteStorage requires sqlite3 or pysqlite2")
+        self.db_fn = db_fn
+        self.conn  = sqlite3.connect(db_fn)
+        self.conn.text_factory = str
+        for stmt in self.SCHEMA:
+            self.conn.execute(stmt)
+        self.conn.commit()
+
+    def close(self):
+        """Close the database."""
+        self.conn.close()
+
+    def getURIs(self):
+        """
+        Get a list of feed URIs in the cache.
+        """
+        rows = self.conn.execute("SELECT uri FROM feeds")
+        return [ row[0] for row in rows ]
+
+    def getDueURIs(self, now, refresh_period):
+        """
+        Get a list of feed URIs due for a refresh.  Records saved 
+        without a schedule fall back to the refresh period since their
+        last poll.
+        """
+        rows = self.conn.execute("""
+            SELECT uri FROM feeds WHERE next_poll <= ?
+            UNION ALL
+            SELECT uri FROM feeds 
+            WHERE next_poll IS NULL AND last_poll + ? <= ?
+        """, (now, refresh_period, now))
+        return [ row[0] for row in rows ]
+
+    def load(self, feed_uri, default=None, with_data=True):
+        """
+        Load a FeedCacheRecord from the database, optionally skipping 
+        the parsed feed data.
+        """
+        row = self.conn.execute("""
+            SELECT last_poll, etag, modified, next_poll, interval, history 
+            FROM feeds WHERE uri = ?
+        """, (feed_uri,)).fetchone()
+        if row is None: 
+            return default
+
+        (last_poll, etag, modified, next_poll, interval, history) = row
+        rec = FeedCacheRecord(last_poll, etag, modified, None, 
+            next_poll, interval, 
+            [ int(x) for x in (history or '').split(',') if x ])
+
+        if with_data:
+            row = self.conn.execute(
+                "SELECT data FROM feed_data WHERE uri = ?", 
+                (feed_uri,)).fetchone()
+            if row is not None and row[0] is not None:
+                rec.data = pickle.loads(str(row[0]))
+
+        return rec
+
+    def save(self, feed_uri, record):
+        """
+        Save a FeedCacheRecord to the database.  The parsed feed data is
+        only written if the record has any, so saving a record loaded 
+        without its data leaves the stored data alone.
+        """
+        self.conn.execute("""
+            INSERT OR REPLACE INTO feeds 
+                (uri, last_poll, etag, modified, next_poll, interval, history)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (feed_uri, record.last_poll, record.etag, 
+              httpDate(record.modified), record.next_poll, record.interval,
+              ','.join([ str(x) for x in record.history ])))
+
+        if record.data is not None:
+            data = pickle.dumps(record.data, pickle.HIGHEST_PROTOCOL)
+            self.conn.execute("""
+                INSERT OR REPLACE INTO feed_data (uri, data) VALUES (?, ?)
+            """, (feed_uri, sqlite3.Binary(data)))
+
+        self.conn.commit()
+
+def httpDate(modified):
+    """
+    Convert a Last-Modified value to text fit for an If-Modified-Since
+    header, whether it started out as text or as a time tuple.
+    """
+    if modified is None or type(modified) in (str, unicode):
+        return modified
+    return time.strftime("%a, %d %b %Y %H:%M:%S GMT", tuple(modified))
+
+def migrateCache(src, dest):
+    """
+    Copy all the records from one feed cache storage into another,
+    returning the number of records copied.
+    """
+    count = 0
+    for uri, rec in src.getRecords():
+        dest.save(uri, rec)
+        count += 1
+    return count
+
+class ParsedFeedCache:
+    """
+    Cache of feedparser results keyed by an MD5 hash of the raw feed 
+    content, shared through a SQLite database so that the same content
+    is never parsed twice, even by different processes.  Results are
+    stored with marshal, and the least recently used are evicted once
+    they take up more than max_bytes in all.
+    """
+    DB_FN     = ".parsed_feeds.db"
+    MAX_BYTES = 32 * 1024 * 1024
+
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS parsed (
+               hash      TEXT PRIMARY KEY,
+               size      INTEGER,
+               last_used REAL,
+               data      BLOB
+           )""",
+        """CREATE INDEX IF NOT EXISTS parsed_last_used 
+               ON parsed (last_used)""",
+    ]
+
+    def __init__(self, db_fn=DB_FN, max_bytes=MAX_BYTES):
+        """
+        Initialize the cache, opening the database and creating the
+        table if necessary.
+        """
+        if sqlite3 is None:
+            raise ImportError("ParsedFeedCache requires sqlite3 or pysqlite2")
+        self.db_fn     = db_fn
+        self.max_bytes = max_bytes
+        self.conn      = sqlite3.connect(db_fn)
+        self.conn.text_factory = str
+        for stmt in self.SCHEMA:
+            self.conn.execute(stmt)
+        self.conn.commit()
+
+    def parse(self, content):
+        """
+        Parse raw feed content with feedparser, or return the result 
+        cached from parsing identical content before.
+        """
+        hash = md5.md5(content).hexdigest()
+        row  = self.conn.execute(
+            "SELECT data FROM parsed WHERE hash = ?", (hash,)).fetchone()
+        if row is not None:
+            self.conn.execute(
+                "UPDATE parsed SET last_used = ? WHERE hash = ?", 
+                (time.time(), hash))
+            self.conn.commit()
+            return unpackParsed(marshal.loads(str(row[0])))
+
+        feed_data = feedparser.parse(content)
+        try:
+            data = marshal.dumps(packParsed(feed_data))
+        except ValueError:
+            # Something in there marshal can't handle, so don't cache it.
+            return feed_data
+        self.conn.execute("""
+            INSERT OR REPLACE INTO parsed (hash, size, last_used, data) 
+            VALUES (?, ?, ?, ?)
+        """, (hash, len(data), time.time(), sqlite3.Binary(data)))
+        self.evict()
+        self.conn.commit()
+        return feed_data
+
+    def evict(self):
+        """
+        Delete the least recently used results until the rest fit in
+        max_bytes, without committing.
+        """
+        total = self.conn.execute(
+            "SELECT SUM(size) FROM parsed").fetchone()[0] or 0
+        if total <= self.max_bytes: return
+        doomed = []
+        for hash, size in self.conn.execute(
+                "SELECT hash, size FROM parsed ORDER BY last_used"):
+            if total <= self.max_bytes: break
+            doomed.append((hash,))
+            total -= size
+        self.conn.executemany("DELETE FROM parsed WHERE hash = ?", doomed)
+
+    def close(self):
+        """Close the database."""
+        self.conn.close()
+
+def packParsed(data):
+    """
+    Convert feedparser results into plain dicts, lists and tuples that
+    marshal can store, dropping any parsing exception.
+    """
+    if isinstance(data, dict):
+        return dict([ (k, packParsed(v)) for k, v in data.items()
+                      if k != 'bozo_exception' ])
+    if isinstance(data, list):
+        return [ packParsed(x) for x in data ]
+    if isinstance(data, time.struct_time):
+        return tuple(data)
+    return data
+
+def unpackParsed(data):
+    """
+    Rebuild feedparser results from packParsed() output, with dicts 
+    allowing attribute access and parsed dates as time tuples again.
+    """
+    if isinstance(data, dict):
+        out = feedparser.FeedParserDict()
+        for k, v in data.items():
+            if k.endswith('_parsed') and type(v) is tuple:
+                v = time.struct_time(v)
+            else:
+                v = unpackParsed(v)
+            dict.__setitem__(out, k, v)
+        return out
+    if isinstance(data, list):
+        return [ unpackParsed(x) for x in data ]
+    return data
+
 def parse(feed_uri, cache=None, **kw):
     """
     Partial feedparser API emulation, only accepts a URI.
     """
     return (cache or FeedCache()).parse(feed_uri, **kw)
 
+def parseContent(content, cache=None):
+    """
+    Parse raw feed content, using a ParsedFeedCache to skip parsing 
+    content already seen.
+    """
+    if cache is not None:
+        return cache.parse(content)
+    cache = ParsedFeedCache()
+    try:
+        return cache.parse(content)
+    finally:
+        cache.close()
+
 if __name__=='__main__': main()
@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+"""
+feedcache_migrate.py
+
+Import a directory of pickled feed cache records into a SQLite
+feed cache database.
+"""
+import sys
+from feedcache import FeedCache, PickleDirStorage, SQLiteStorage
+from feedcache import migrateCache
+
+def main():
+    """
+    Usage: feedcache_migrate.py [<cache dir> [<database file>]]
+    """
+    cache_dir = ( len(sys.argv) > 1 ) and sys.argv[1] or FeedCache.CACHE_DIR
+    db_fn     = ( len(sys.argv) > 2 ) and sys.argv[2] or SQLiteStorage.DB_FN
+
+    src  = PickleDirStorage(cache_dir)
+    dest = SQLiteStorage(db_fn)
+    
+    count = migrateCache(src, dest)
+    dest.close()
+    
+    print "Imported %s feeds from %s into %s" % (count, cache_dir, db_fn)
+
+if __name__ == '__main__': main()
@@ -0,0 +1,369 @@
+#!/usr/bin/env python
+"""
+fetchlib.py
+
+Shared HTTP fetching for scrapers and friends.  Connections are kept
+alive and reused per host, responses compressed with gzip or deflate
+are decoded on the fly, and a fetch cache remembers validators (ETag
+and Last-Modified) along with the last body fetched, so that repeat
+fetches can be conditional GETs answered with a 304.  URLs with other
+schemes, such as ftp, are fetched with urllib2 instead.
+"""
+import sys, time, socket, shelve, httplib, urllib2, zlib, threading
+from urlparse import urlparse, urljoin
+
+USER_AGENT      = "fetchlib/0.1"
+DEFAULT_TIMEOUT = 30
+MAX_REDIRECTS   = 5
+MAX_IDLE        = 2
+READ_CHUNK      = 16 * 1024
+
+REDIRECT_CODES  = (301, 302, 303, 307)
+
+def main():
+    """
+    Fetch a URL, using a fetch cache if given, and report on the result.
+    Usage: fetchlib.py <url> [cache filename]
+    """
+    cache = (len(sys.argv) > 2) and FetchCache(sys.argv[2]) or None
+    start = time.time()
+    resp  = fetch(sys.argv[1], cache)
+    data  = resp.read()
+    print "%s %s (%s bytes%s) in %0.3f seconds" % \
+        (resp.status, resp.url, len(data),
+         resp.not_modified and ", from cache" or "", time.time() - start)
+
+class FetchError(Exception):
+    """Raised for HTTP errors and redirect loops."""
+    def __init__(self, url, status, reason):
+        Exception.__init__(self, "%s %s: %s" % (status, reason, url))
+        self.url    = url
+        self.status = status
+        self.reason = reason
+
+class ConnectionPool:
+    """
+    Pool of idle keep-alive HTTP connections, keyed by scheme and host.
+    """
+    def __init__(self, max_idle=MAX_IDLE, timeout=DEFAULT_TIMEOUT):
+        """Initialize an empty pool."""
+        self.max_idle = max_idle
+        self.timeout  = timeout
+        self.idle     = {}
+        self.lock     = threading.Lock()
+
+    def get(self, scheme, netloc):
+        """
+        Return a (connection, reused) tuple for a host, reusing an idle
+        connection if there is one.
+        """
+        self.lock.acquire()
+        try:
+            conns = self.idle.get((scheme, netloc), [])
+            if conns: return (conns.pop(), True)
+        finally:
+            self.lock.release()
+        return (self.new(scheme, netloc), False)
+
+    def new(self, scheme, netloc):
+        """Return a new connection to a host."""
+        if scheme == 'https':
+            return httplib.HTTPSConnection(netloc, timeout=self.timeout)
+        return httplib.HTTPConnection(netloc, timeout=self.timeout)
+
+    def put(self, scheme, netloc, conn):
+        """Return a connection to the pool for reuse, or close it."""
+        self.lock.acquire()
+        try:
+            conns = self.idle.setdefault((scheme, netloc), [])
+            if len(conns) < self.max_idle:
+                conns.append(conn)
+                return
+        finally:
+            self.lock.release()
+        conn.close()
+
+    def close_all(self):
+        """Close all idle connections."""
+        self.lock.acquire()
+        try:
+            for conns in self.idle.values():
+                for conn in conns: conn.close()
+            self.idle = {}
+        finally:
+            self.lock.release()
+
+POOL = ConnectionPool()
+
+class FetchCache:
+    """
+    Dict-like store, kept in a shelve, of validators and the last body
+    fetched for each URL.  The shelve is only open while a record is 
+    being read or written, since a response may be read long after the
+    fetch that started it.
+    """
+    def __init__(self, cache_fn):
+        """Initialize with the cache shelve filename."""
+        self.cache_fn = cache_fn
+
+    def get(self, url, default=None):
+        """Return the cached record for a URL."""
+        db = shelve.open(self.cache_fn)
+        try:
+            if db.has_key(url): return db[url]
+            return default
+        finally:
+            db.close()
+
+    def __setitem__(self, url, record):
+        """Store the record for a URL."""
+        db = shelve.open(self.cache_fn)
+        try:
+            db[url] = record
+        finally:
+            db.close()
+
+class FetchResponse:
+    """
+    File-like response to a fetch, decoding any content encoding as it
+    is read.  A response to a conditional GET answered with a 304 reads
+    back the body remembered in the fetch cache.
+    """
+    def __init__(self, url, status, headers, resp=None, conn=None,
+            release=None, cached=None, cache=None, partial=False):
+        """Initialize with the response details."""
+        self.url          = url
+        self.status       = status
+        self.headers      = headers
+        self.not_modified = (status == 304)
+        self.has_body     = True
+        self.bytes_read   = 0
+        self._resp        = resp
+        self._conn        = conn
+        self._release     = release
+        self._cache       = cache
+        self._partial     = partial
+        self._parts       = []
+        self._chunks      = []
+        self._buffered    = 0
+        self._done        = (resp is None)
+        if self.not_modified:
+            self._chunks   = [ cached.get('data', None) or '' ]
+            self._buffered = len(self._chunks[0])
+            self.has_body  = (cached.get('data', None) is not None)
+
+        encoding = headers.get('content-encoding', '').lower()
+        if encoding in ('gzip', 'x-gzip'):
+            self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            self._decoder = DeflateDecoder()
+        else:
+            self._decoder = None
+
+    def read(self, size=-1):
+        """Read up to size bytes of the decoded body, or all of it."""
+        while not self._done and (size < 0 or self._buffered < size):
+            self._fill()
+        buffer = ''.join(self._chunks)
+        if size < 0 or size >= len(buffer):
+            data, self._chunks = buffer, []
+        else:
+            data, self._chunks = buffer[:size], [ buffer[size:] ]
+        self._buffered = len(buffer) - len(data)
+        return data
+
+    def close(self):
+        """
+        Finish with the response.  A fully read connection goes back to
+        the pool, while one abandoned partway through is closed.  For a 
+        partial read, validators are remembered without any content.
+        """
+        if self._conn is not None:
+            if not self._done and self._partial and \
+                    self._cache is not None and self.status == 200:
+                self._remember(None)
+            if self._done and not self._resp.will_close:
+                self._release(self._conn)
+            else:
+                self._conn.close()
+            self._conn = None
+        elif self._resp is not None and self._release is None:
+            self._resp.close()
+            self._done = True
+
+    def _fill(self):
+        """Read and decode the next chunk of the raw response."""
+        raw = self._resp.read(READ_CHUNK)
+        self.bytes_read += len(raw)
+        if raw:
+            data = self._decoder and self._decoder.decompress(raw) or raw
+        else:
+            data = self._decoder and self._decoder.flush() or ''
+            self._done = True
+        if data:
+            self._chunks.append(data)
+            self._buffered += len(data)
+        if self._cache is not None:
+            self._parts.append(data)
+        if self._done:
+            self._finish()
+
+    def _finish(self):
+        """Remember validators and the body, once fully read."""
+        if self._cache is not None and self.status == 200:
+            self._remember(''.join(self._parts))
+        self._parts = []
+        self.close()
+
+    def _remember(self, data):
+        """Store validators and content in the fetch cache."""
+        self._cache[self.url] = {
+            'etag'          : self.headers.get('etag', None),
+            'last_modified' : self.headers.get('last-modified', None),
+            'data'          : data
+        }
+
+class DeflateDecoder:
+    """
+    Decoder for deflate content, which some servers send as a raw
+    deflate stream rather than the zlib stream the spec calls for.
+    """
+    def __init__(self):
+        """Initialize expecting a zlib stream."""
+        self.decoder = zlib.decompressobj()
+        self.first   = True
+
+    def decompress(self, data):
+        """Decode data, falling back to raw deflate on the first chunk."""
+        if self.first:
+            self.first = False
+            try:
+                return self.decoder.decompress(data)
+            except zlib.error:
+                self.decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self.decoder.decompress(data)
+
+    def flush(self):
+        """Return any remaining decoded data."""
+        return self.decoder.flush()
+
+def fetch(url, cache=None, headers=None, pool=POOL,
+        max_redirects=MAX_REDIRECTS, partial=False, conditional=True):
+    """
+    Fetch a URL, following redirects, and return a FetchResponse.  Given
+    a FetchCache (or any dict-like with a get method), a conditional GET
+    is made using the validators remembered for the URL, and a fully
+    read 200 response updates them.  Raises FetchError for HTTP errors.
+
+    A caller which may only read the start of the response should pass
+    partial=True.  Validators are then remembered even when the content
+    isn't, and a 304 means the content is the same as last time, though
+    the response has none to read back, and has_body is False.  
+    
+    With conditional=False, no validators are sent, but the response
+    still updates the cache.
+
+    URLs with schemes other than http and https are fetched with 
+    urllib2, without the cache or connection pool.
+    """
+    if urlparse(url)[0] not in ('http', 'https'):
+        return _fetch_other(url, headers, pool.timeout)
+
+    for redirect in range(max_redirects + 1):
+        req_headers = {
+            'User-Agent'      : USER_AGENT,
+            'Accept-Encoding' : 'gzip, deflate',
+        }
+        req_headers.update(headers or {})
+
+        cached = cache is not None and cache.get(url, None) or None
+        if not conditional: cached = None
+        if cached and (partial or cached.get('data', None) is not None):
+            if cached.get('etag', None):
+                req_headers['If-None-Match'] = cached['etag']
+            if cached.get('last_modified', None):
+                req_headers['If-Modified-Since'] = cached['last_modified']
+
+        (scheme, netloc, path, params, query, frag) = urlparse(url)
+        if scheme not in ('http', 'https'):
+            # Redirected away from HTTP.
+            return _fetch_other(url, headers, pool.timeout)
+        path = path or '/'
+        if params: path = '%s;%s' % (path, params)
+        if query:  path = '%s?%s' % (path, query)
+
+        conn, resp = _request(pool, scheme, netloc, path, req_headers)
+        resp_headers = dict([ (k.lower(), v)
+                              for k, v in resp.getheaders() ])
+
+        if resp.status in REDIRECT_CODES and resp_headers.has_key('location'):
+            resp.read()
+            _release(pool, scheme, netloc, conn, resp)
+            url = urljoin(url, resp_headers['location'])
+            continue
+
+        if resp.status == 304 and cached:
+            resp.read()
+            _release(pool, scheme, netloc, conn, resp)
+            return FetchResponse(url, 304, resp_headers, cached=cached)
+
+        if resp.status != 200:
+            resp.read()
+            _release(pool, scheme, netloc, conn, resp)
+            raise FetchError(url, resp.status, resp.reason)
+
+        release = lambda c, s=scheme, n=netloc: pool.put(s, n, c)
+        return FetchResponse(url, 200, resp_headers, resp, conn,
+                             release, cache=cache, partial=partial)
+
+    raise FetchError(url, 0, "Too many redirects")
+
+def fetch_data(url, cache=None, headers=None):
+    """Fetch a URL and return the whole decoded body."""
+    resp = fetch(url, cache, headers)
+    data = resp.read()
+    resp.close()
+    return data
+
+def _fetch_other(url, headers, timeout):
+    """
+    Fetch a URL with urllib2, for schemes this module doesn't handle,
+    and return a FetchResponse.  Raises FetchError on failure.
+    """
+    req_headers = { 'User-Agent' : USER_AGENT }
+    req_headers.update(headers or {})
+    req = urllib2.Request(url, headers=req_headers)
+    try:
+        resp = urllib2.urlopen(req, timeout=timeout)
+    except urllib2.HTTPError, e:
+        raise FetchError(url, e.code, e.msg)
+    except (urllib2.URLError, IOError), e:
+        raise FetchError(url, 0, str(getattr(e, 'reason', e)))
+    resp_headers = dict([ (k.lower(), v) for k, v in resp.info().items() ])
+    return FetchResponse(resp.geturl(), 200, resp_headers, resp)
+
+def _request(pool, scheme, netloc, path, headers):
+    """
+    Send a GET request on a pooled connection and return the connection
+    and response.  A reused connection the server has since closed gets
+    one retry on a fresh connection.
+    """
+    conn, reused = pool.get(scheme, netloc)
+    try:
+        conn.request('GET', path, headers=headers)
+        return (conn, conn.getresponse())
+    except (httplib.HTTPException, socket.error):
+        conn.close()
+        if not reused: raise
+    conn = pool.new(scheme, netloc)
+    conn.request('GET', path, headers=headers)
+    return (conn, conn.getresponse())
+
+def _release(pool, scheme, netloc, conn, resp):
+    """Return a connection to the pool, unless the server is closing it."""
+    if resp.will_close:
+        conn.close()
+    else:
+        pool.put(scheme, netloc, conn)
+
+if __name__ == '__main__': main()
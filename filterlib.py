@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+"""
+filterlib.py
+
+Compiled multi-pattern matching for filtering records, such as log
+events or feed entries, on field values.  Each field's exact values,
+substrings and regexes are compiled once into a lookup table and a
+combined regex, and every rule keeps a count of how often it fires.
+"""
+import sys, re
+from ConfigParser import ConfigParser
+
+# Python's re module only allows so many groups in one regex, so long
+# lists of rules get split across several combined regexes.
+MAX_GROUPS = 99
+
+# Config value standing in for an empty string, which ConfigParser
+# can't otherwise express in a list.
+EMPTY_VALUE = '<empty>'
+
+def main():
+    """
+    Filter lines from stdin as values of a field, using rules loaded
+    from a config file.  Passing lines are printed, followed by a
+    report of rule hits on stderr.
+    Usage: filterlib.py <config file> <field>
+    """
+    rules = loadFilter(sys.argv[1])
+    field = sys.argv[2]
+    for line in sys.stdin:
+        if not rules.matchAny({ field : line.rstrip('\n') }):
+            sys.stdout.write(line)
+    sys.stderr.write(formatHits(rules, True))
+
+class FieldRules:
+    """
+    Compiled rules for matching values of one field.  Exact values are
+    looked up in a dict, substrings are found with one combined search,
+    and regexes are tried with one combined match from the start of the
+    value.
+    """
+    def __init__(self, exact=[], partial=[], regex=[], flags=0):
+        """
+        Initialize with lists of exact values, substrings and regexes.
+        """
+        self.exact    = dict([ (x, 'exact:%s' % x) for x in exact ])
+        self.partial  = combineRegexes([ re.escape(x) for x in partial ],
+                            [ 'partial:%s' % x for x in partial ],
+                            flags, False)
+        self.regex    = combineRegexes(regex,
+                            [ 'regex:%s' % x for x in regex ],
+                            flags, True)
+        self.hits     = {}
+        for rule in self.exact.values():
+            self.hits[rule] = 0
+        for regex, anchored, groups in self.partial + self.regex:
+            for rule in groups.values():
+                self.hits[rule] = 0
+
+    def match(self, value):
+        """
+        Return the name of the first rule matching a value, counting the
+        hit, or None if no rule matches.
+        """
+        rule = self.exact.get(value, None)
+        if rule is None:
+            for regex, anchored, groups in self.partial + self.regex:
+                if anchored:
+                    m = regex.match(value)
+                else:
+                    m = regex.search(value)
+                if m:
+                    rule = groups[m.lastindex]
+                    break
+        if rule is not None:
+            self.hits[rule] += 1
+        return rule
+
+    def matchMany(self, values):
+        """
+        Return a list of the first rule matching each of a list of 
+        values, or None for values no rule matches.  Each distinct value
+        is only matched once, but hits are counted for every value.
+        """
+        seen, rules = {}, []
+        for value in values:
+            if seen.has_key(value):
+                rule = seen[value]
+                if rule is not None:
+                    self.hits[rule] += 1
+            else:
+                rule = seen[value] = self.match(value)
+            rules.append(rule)
+        return rules
+
+def combineRegexes(patterns, names, flags=0, anchored=False):
+    """
+    Combine a list of regex patterns into as few alternation regexes
+    as possible.  Returns a list of (regex, anchored, groups) tuples,
+    where groups maps the index of each pattern's wrapping group to its
+    rule name.
+    """
+    combined, parts, groups, count = [], [], {}, 0
+    for pattern, name in zip(patterns, names):
+        inner = re.compile(pattern, flags).groups
+        if parts and count + inner + 1 > MAX_GROUPS:
+            combined.append((re.compile('|'.join(parts), flags),
+                             anchored, groups))
+            parts, groups, count = [], {}, 0
+        parts.append('(%s)' % pattern)
+        groups[count + 1] = name
+        count += inner + 1
+    if parts:
+        combined.append((re.compile('|'.join(parts), flags),
+                         anchored, groups))
+    return combined
+
+class RuleFilter:
+    """
+    Set of compiled FieldRules, keyed by field name, with hit counts.
+    """
+    def __init__(self, exact={}, partial={}, regex={}, flags=0):
+        """
+        Initialize with maps of field name to lists of exact values,
+        substrings and regexes.  A single string is taken as a list of
+        one.
+        """
+        self.fields = {}
+        for field in unique(exact.keys() + partial.keys() + regex.keys()):
+            self.fields[field] = FieldRules(
+                asList(exact.get(field, [])),
+                asList(partial.get(field, [])),
+                asList(regex.get(field, [])), flags)
+
+    def matchAny(self, record):
+        """
+        Return a (field, rule) tuple for the first rule matching any
+        field of a record, or None if none match.  Useful for exclusion.
+        """
+        for field, rules in self.fields.items():
+            if record.has_key(field):
+                rule = rules.match(record[field])
+                if rule is not None:
+                    return (field, rule)
+        return None
+
+    def matchAll(self, record):
+        """
+        Return whether every field with rules has a value in the record
+        matching at least one of them.  Useful for inclusion.
+        """
+        for field, rules in self.fields.items():
+            if not (record.has_key(field) and
+                    rules.match(record[field]) is not None):
+                return False
+        return True
+
+    def getHits(self):
+        """
+        Return a list of ((field, rule), count) tuples, most hits first.
+        """
+        hits = []
+        for field, rules in self.fields.items():
+            hits.extend([ ((field, rule), count)
+                          for rule, count in rules.hits.items() ])
+        hits.sort(lambda a, b: cmp(b[1], a[1]) or cmp(a[0], b[0]))
+        return hits
+
+    def resetHits(self):
+        """Zero all the hit counts."""
+        for rules in self.fields.values():
+            for rule in rules.hits.keys():
+                rules.hits[rule] = 0
+
+def formatHits(rule_filter, show_all=False):
+    """
+    Return a report of rule hits, one line per rule with the most hits
+    first.  Rules which never fired are left out, unless show_all is
+    true.
+    """
+    return ''.join([ "%8d  %s %s\n" % (count, field, rule)
+                     for (field, rule), count in rule_filter.getHits()
+                     if count or show_all ])
+
+def loadFilter(config_fn, flags=0):
+    """
+    Build a RuleFilter from a config file with a section per field,
+    each with optional exact, partial and regex options listing one
+    value per line.  Use <empty> for an empty string value, eg.:
+
+        [referrer]
+        exact   = <empty>
+                  -
+        partial = poker
+                  casino
+    """
+    config = ConfigParser()
+    config.read(config_fn)
+    maps = { 'exact' : {}, 'partial' : {}, 'regex' : {} }
+    for field in config.sections():
+        for kind, rules in maps.items():
+            if config.has_option(field, kind):
+                rules[field] = [ (x != EMPTY_VALUE) and x or ''
+                    for x in [ y.strip() for y in
+                               config.get(field, kind, True).split('\n') ]
+                    if x ]
+    return RuleFilter(maps['exact'], maps['partial'], maps['regex'], flags)
+
+def asList(val):
+    """Return a list, wrapping a lone string in one."""
+    if type(val) in (str, unicode): return [ val ]
+    return list(val)
+
+def unique(vals):
+    """Return a list of unique values, keeping the order first seen."""
+    seen, out = {}, []
+    for val in vals:
+        if not seen.has_key(val):
+            seen[val] = 1
+            out.append(val)
+    return out
+
+if __name__ == '__main__': main()
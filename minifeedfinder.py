@@ -7,7 +7,7 @@ HTMLParser from the standard Python library.
 """
 
 import sys
-from urllib2    import urlopen
+from fetchlib   import fetch_data
 from urlparse   import urljoin
 from HTMLParser import HTMLParser, HTMLParseError
 
@@ -66,7 +66,7 @@ def getFeedsDetail(url):
     """
     Load up the given URL, parse, and return any feeds found.
     """
-    data   = urlopen(url).read()
+    data   = fetch_data(url)
     parser = FeedAutodiscoveryParser(url)
     
     try:
@@ -6,14 +6,31 @@ a reasonable job extracting data from RSS 1.0, RSS 2.0, and Atom 0.3 feeds.
 """
 from sgmllib   import SGMLParser
 from httpcache import HTTPCache
+from xml.parsers import expat
 
-def parse(feed_uri):
+def parse(feed_uri, fast=False, fields=None, max_entries=None):
     """
     Create a throwaway parser object and return the results of 
-    parsing for the given feed URL
+    parsing for the given feed URL.  The fast parser expects well-formed
+    XML, but falls back to the forgiving one if it doesn't get it.
+
+    Given a list of fields, only those properties are kept for the feed
+    and its entries.  Given max_entries, parsing stops once that many 
+    entries are found.  Either one implies the fast parser.
     """
+    if fast or fields is not None or max_entries is not None:
+        return MiniFeedPullParser(fields, max_entries).parse(feed_uri)
     return MiniFeedParser().parse(feed_uri)
 
+def iter_entries(feed_uri, fields=None, max_entries=None):
+    """
+    Yield entries from the given feed URL one at a time, as the fast
+    parser finishes each.  If the feed turns out not to be well-formed
+    XML, the rest of the entries come from the forgiving parser.
+    """
+    content = HTTPCache(feed_uri).content()
+    return MiniFeedPullParser(fields, max_entries).iter_entries(content)
+
 class MiniFeedParser(SGMLParser):
 
     def parse(self, feed_uri):
@@ -22,6 +39,10 @@ class MiniFeedParser(SGMLParser):
         cache        = HTTPCache(feed_uri)
         feed_content = cache.content()
         
+        return self.parse_string(feed_content)
+
+    def parse_string(self, feed_content):
+        """Given the content of a feed, return parsed data."""
         self.reset()
         self.feed(feed_content)
         
@@ -167,4 +188,192 @@ class MiniFeedParser(SGMLParser):
     }
     PROP_MAPS['atom??'] = PROP_MAPS['atom03']
     PROP_MAPS['rss??']  = PROP_MAPS['rss20']
-    
+
+class MiniFeedPullParser:
+    """
+    Faster feed parser built on expat, returning much the same data as
+    MiniFeedParser.  Text is collected in lists and joined once per 
+    element, entities are decoded by expat, and entries can be yielded
+    one at a time as each is finished.  Unlike MiniFeedParser, which 
+    drops CDATA sections, this keeps their content, so a summary in
+    CDATA comes back as its text rather than ''.
+
+    Parsing can be limited to a list of fields, in which case text for 
+    any other element isn't even buffered, and to a maximum number of 
+    entries, after which no more input is read.  Feed properties which
+    come after the last entry wanted are missed.
+    """
+    CHUNK_SIZE = 16 * 1024
+    PROP_MAPS  = MiniFeedParser.PROP_MAPS
+    ENTRY_TAGS = ( 'item', 'entry' )
+
+    def __init__(self, fields=None, max_entries=None):
+        """Initialize with optional field and entry limits."""
+        self.fields      = (fields is not None) and \
+            dict([ (x, 1) for x in fields ]) or None
+        self.max_entries = max_entries
+
+    def parse(self, feed_uri):
+        """Given a URI to a feed, fetch it and return parsed data."""
+        return self.parse_string(HTTPCache(feed_uri).content())
+
+    def parse_string(self, feed_content):
+        """
+        Given the content of a feed, return parsed data.  Content which
+        isn't well-formed XML is handed to MiniFeedParser instead.
+        """
+        entries = list(self.iter_entries(feed_content))
+        return {
+            'version'  : self._version,
+            'feed'     : self._feed,
+            'entries'  : entries
+        }
+
+    def iter_entries(self, source):
+        """
+        Parse feed content, given as a string or file-like object, a 
+        chunk at a time, yielding each entry as it is finished.  The 
+        feed version and metadata are available as self._version and 
+        self._feed once done.
+
+        Content given as a string which turns out not to be well-formed
+        XML, say with an HTML entity like &nbsp;, is handed to 
+        MiniFeedParser, and the entries after those already yielded come
+        from there.  A file-like object can't be read again, so then
+        expat.ExpatError is raised, possibly after some entries.
+        """
+        count = 0
+        try:
+            for entry in self._iter_parsed(source):
+                yield entry
+                count += 1
+        except expat.ExpatError:
+            if hasattr(source, 'read'): raise
+            result = self.limit(MiniFeedParser().parse_string(source))
+            self._version = result['version']
+            self._feed    = result['feed']
+            for entry in result['entries'][count:]:
+                yield entry
+
+    def _iter_parsed(self, source):
+        """Yield entries parsed from the content with expat."""
+        self.reset()
+        parser = expat.ParserCreate()
+        parser.returns_unicode      = False
+        parser.buffer_text          = True
+        parser.StartElementHandler  = self.start_element
+        parser.EndElementHandler    = self.end_element
+        parser.CharacterDataHandler = self.handle_data
+
+        if hasattr(source, 'read'):
+            read = source.read
+        else:
+            chunks = [ source[x:x + self.CHUNK_SIZE] 
+                       for x in xrange(0, len(source), self.CHUNK_SIZE) ]
+            chunks.reverse()
+            read = lambda size: chunks and chunks.pop() or ''
+
+        count = 0
+        while True:
+            data = read(self.CHUNK_SIZE)
+            parser.Parse(data, not data)
+            while self._done and count != self.max_entries:
+                yield self._done.pop(0)
+                count += 1
+            if not data or count == self.max_entries: break
+
+    def limit(self, result):
+        """Apply the field and entry limits to fully parsed data."""
+        if self.max_entries is not None:
+            result['entries'] = result['entries'][:self.max_entries]
+        if self.fields is not None:
+            for data in [ result['feed'] ] + result['entries']:
+                for name in data.keys():
+                    if not self.fields.has_key(name): del data[name]
+        return result
+
+    def reset(self):
+        """Initialize the parser state."""
+        self._version = "unknown"
+        self._feed    = self.wanted({
+            'title'    : '',
+            'link'     : '',
+            'author'   : '',
+            'modified' : '',
+        })
+        self._done  = []
+        self._entry = None
+        self._depth = 0
+        self._text  = []
+        self._keep  = [ True ]
+
+    def wanted(self, data):
+        """Return a dict of default properties, limited to wanted fields."""
+        if self.fields is None: return data
+        return dict([ (k, v) for k, v in data.items() 
+                      if self.fields.has_key(k) ])
+
+    def start_element(self, name, attrs):
+        """Handle an element start, noting feed version and entries."""
+        tag = name.lower()
+
+        if self._depth == 0:
+            if tag == 'rdf:rdf':
+                self._version = "rss10"
+            elif tag == 'rss':
+                self._version = (attrs.get('version', '???') == '2.0') \
+                    and "rss20" or "rss??"
+            elif tag == 'feed':
+                self._version = (attrs.get('version', '???') == '0.3') \
+                    and "atom03" or "atom??"
+        self._depth += 1
+
+        if tag in self.ENTRY_TAGS:
+            self._entry = self.wanted({
+                'title'   : '',
+                'link'    : '',
+                'modified': '',
+                'summary' : '',
+                'content' : '',
+            })
+            self._keep.append(False)
+            return
+
+        keep = (self.fields is None or 
+                self.fields.has_key(self.translate_prop_name(tag)))
+        self._keep.append(keep)
+
+        if keep and tag == 'link' and 'atom' in self._version:
+            self.current()['link'] = attrs.get('href', '')
+
+    def handle_data(self, data):
+        """Buffer text data, if it's for a wanted element."""
+        if self._keep[-1]: self._text.append(data)
+
+    def end_element(self, name):
+        """Handle an element end, setting a property from its text."""
+        tag = name.lower()
+        self._depth -= 1
+        keep = self._keep.pop()
+
+        value, self._text = ''.join(self._text).strip(), []
+
+        if tag in self.ENTRY_TAGS:
+            self._done.append(self._entry)
+            self._entry = None
+        elif keep and not (tag == 'link' and 'atom' in self._version):
+            self.current()[self.translate_prop_name(tag)] = value
+
+    def current(self):
+        """Return the entry being parsed, or the feed metadata."""
+        if self._entry is not None: return self._entry
+        return self._feed
+
+    def translate_prop_name(self, name):
+        """Map an element name to a property name for the feed version."""
+        map = self.PROP_MAPS.get(self._version, {})
+        if self._entry is not None and map.has_key('entry'):
+            return map['entry'].get(name, name)
+        if self._entry is None and map.has_key('feed'):
+            return map['feed'].get(name, name)
+        return name
@@ -4,9 +4,26 @@ monitorfeedlib.py
 
 Utilities for building feeds from system logs and reports.
 """
-import sys, os, os.path, time, md5, difflib, gzip
-from cPickle import dump, load
+import sys, os, os.path, time, md5, difflib, gzip, mmap, struct
+from cPickle import dump, load, dumps, loads, HIGHEST_PROTOCOL
 from scraperlib import FeedEntryDict, Scraper
+from sqlitelib import sqlite3
+
+# Filenames of the entry buffer database and ring buffer within a 
+# feed's entries dir.
+ENTRY_DB_FN   = 'entries.sqlite'
+ENTRY_RING_FN = 'entries.ring'
+
+# Ring buffer file layout: a header of magic, slot count, slot size and 
+# next slot to write, then fixed-size slots each starting with the 
+# entry's modified time and the length of its pickle.
+RING_MAGIC       = 'LBRB'
+RING_HEADER      = struct.Struct('<4sIII')
+RING_SLOT_HEADER = struct.Struct('<dI')
+RING_SLOT_SIZE   = 16 * 1024
+
+# Appended to a summary trimmed to fit in a ring buffer slot.
+RING_TRUNCATED   = '... [truncated]'
 
 def main():
     """
@@ -45,16 +62,29 @@ class LogBufferFeed(Scraper):
     MAX_ENTRIES = 50
     MAX_AGE     = 4 * 60 * 6 # 4 hours
     
-    def __init__(self, entries_dir):
-        """Initialize object with the path to pickled entries."""
+    def __init__(self, entries_dir, ring_slots=None, 
+            slot_size=RING_SLOT_SIZE):
+        """
+        Initialize object with the path to buffered entries.  Given a 
+        number of ring slots, entries are kept in a fixed-size ring 
+        buffer, where each new entry replaces the oldest once full.
+        """
         if not os.path.exists(entries_dir): os.makedirs(entries_dir)
         self.entries_dir = entries_dir
         self.STATE_FN    = os.path.join(entries_dir, 'state')
+        if ring_slots:
+            self.buffer = RingEntryBuffer(
+                os.path.join(entries_dir, ENTRY_RING_FN), 
+                ring_slots, slot_size)
+        else:
+            self.buffer = EntryBuffer(
+                os.path.join(entries_dir, ENTRY_DB_FN))
+        self.import_entry_files()
 
     def produce_entries(self):
         """Load up entries and fix up before producing feed."""
-        # Load up all the pickled entries
-        entries = [ load(open(x, 'rb')) for x in self.get_entry_paths() ]
+        # Load up only the newest entries, since no more will be used.
+        entries = self.buffer.newest(self.MAX_ENTRIES)
         
         # Tweak each loaded entry to use proper date format.
         for entry in entries:
@@ -77,26 +107,22 @@ class LogBufferFeed(Scraper):
         entry['id'] = "tag:%s,%s:%s.%s" % \
             (self.TAG_DOMAIN, ymd, self.entries_dir, hash)
 
-        # Build entry's file path based on a hash.
-        entry_fn   = "entry-%s" % hash
-        entry_path = os.path.join(self.entries_dir, entry_fn)
-        
-        # Pickle the entry out to a file.
-        dump(entry, open(entry_path, 'wb'))
+        # Store the entry in the buffer under its hash.
+        self.buffer.append(hash, entry)
 
     def clean_entries(self):
         """Delete entries older than the maximum age."""
-        # Get entry file paths and iterate through them.
-        entry_paths = self.get_entry_paths()
-        for entry_path in entry_paths:
-            
-            # Load up the current entry.
+        self.buffer.expire(time.time() - self.MAX_AGE)
+
+    def import_entry_files(self):
+        """
+        Move entries pickled to individual files, as by earlier versions
+        of this class, into the buffer.
+        """
+        for entry_path in self.get_entry_paths():
             entry = load(open(entry_path, "rb"))
-            
-            # Delete the entry if it's gotten too old.
-            entry_age = time.time() - entry.data['modified']
-            if entry_age > self.MAX_AGE:
-                os.unlink(entry_path)
+            self.buffer.append(os.path.basename(entry_path)[6:], entry)
+            os.unlink(entry_path)
 
     def get_entry_paths(self):
         """Get paths to all the pickled entry files."""
@@ -115,4 +141,226 @@ class LogBufferFeed(Scraper):
                 m.update(v.encode(entry.UNICODE_ENC))
         return m.hexdigest()
 
+class EntryBuffer:
+    """
+    Buffer of pickled feed entries kept in a SQLite table indexed on
+    modified time, so that expiring old entries is one range delete and
+    the newest entries can be read without touching the rest.
+    """
+    def __init__(self, db_path):
+        """Open the buffer database, creating it if need be."""
+        if sqlite3 is None:
+            raise ImportError("EntryBuffer requires sqlite3 or pysqlite2")
+        self.conn = sqlite3.connect(db_path)
+        self.conn.text_factory = str
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS entries (
+                hash     TEXT PRIMARY KEY,
+                modified REAL,
+                data     BLOB
+            )""")
+        self.conn.execute("""
+            CREATE INDEX IF NOT EXISTS entries_modified ON entries (modified)
+        """)
+        self.conn.commit()
+
+    def __len__(self):
+        """Return the number of buffered entries."""
+        return self.conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def append(self, hash, entry):
+        """Add an entry to the buffer, replacing any with the same hash."""
+        self.conn.execute("""
+            INSERT OR REPLACE INTO entries (hash, modified, data) 
+            VALUES (?, ?, ?)
+        """, (hash, entry.data.get('modified', time.time()), 
+              sqlite3.Binary(dumps(entry, HIGHEST_PROTOCOL))))
+        self.conn.commit()
+
+    def expire(self, cutoff):
+        """
+        Delete entries modified before the cutoff time, and return how
+        many were deleted.
+        """
+        cur = self.conn.execute("DELETE FROM entries WHERE modified < ?",
+                                (cutoff,))
+        self.conn.commit()
+        return cur.rowcount
+
+    def newest(self, count):
+        """Return a list of the newest entries, newest first."""
+        return [ loads(str(data)) for (data,) in self.conn.execute("""
+            SELECT data FROM entries ORDER BY modified DESC LIMIT ?
+        """, (count,)) ]
+
+    def close(self):
+        """Close the buffer database."""
+        self.conn.close()
+
+class RingEntryBuffer:
+    """
+    Fixed-capacity buffer of pickled feed entries, kept in a file of
+    equally sized slots which is memory-mapped.  Appending overwrites the
+    oldest slot once all are used, so appends take constant time and the
+    file never grows.
+    """
+    def __init__(self, ring_path, num_slots, slot_size=RING_SLOT_SIZE):
+        """
+        Open the ring buffer file, creating it if need be.  A file with a 
+        different number or size of slots is rebuilt, keeping as many of
+        the newest entries as fit.  A file that's cut short or otherwise
+        unreadable is started afresh.
+        """
+        self.ring_path = ring_path
+        self.num_slots = num_slots
+        self.slot_size = slot_size
+
+        old_entries = []
+        if os.path.exists(ring_path):
+            header = read_ring_header(ring_path)
+            if header is None:
+                os.unlink(ring_path)
+            elif header[1:3] != (num_slots, slot_size):
+                old_ring = RingEntryBuffer(ring_path, header[1], header[2])
+                old_entries = old_ring.newest(num_slots)
+                old_ring.close()
+                os.unlink(ring_path)
+
+        if not os.path.exists(ring_path):
+            fout = open(ring_path, 'wb')
+            fout.write(RING_HEADER.pack(RING_MAGIC, num_slots, slot_size, 0))
+            fout.write('\0' * (num_slots * slot_size))
+            fout.close()
+
+        self.fd   = open(ring_path, 'r+b')
+        self.ring = mmap.mmap(self.fd.fileno(), 0)
+
+        old_entries.reverse()
+        for entry in old_entries:
+            self.append(None, entry)
+
+    def __len__(self):
+        """Return the number of live entries in the buffer."""
+        return len(self._live_slots())
+
+    def append(self, hash, entry):
+        """
+        Write an entry into the next slot, replacing whatever was there.
+        An entry too big for a slot has its summary trimmed to fit.
+        """
+        modified = entry.data.get('modified', time.time())
+        data     = self._fit_entry(entry)
+
+        next_slot = self._read_header()[3]
+        pos = self._slot_pos(next_slot)
+        self.ring[pos:pos + RING_SLOT_HEADER.size + len(data)] = \
+            RING_SLOT_HEADER.pack(modified, len(data)) + data
+        self._write_next((next_slot + 1) % self.num_slots)
+        self.ring.flush()
+
+    def expire(self, cutoff):
+        """
+        Empty slots holding entries modified before the cutoff time, and
+        return how many were emptied.
+        """
+        count = 0
+        for modified, slot in self._live_slots():
+            if modified < cutoff:
+                pos = self._slot_pos(slot)
+                self.ring[pos:pos + RING_SLOT_HEADER.size] = \
+                    RING_SLOT_HEADER.pack(0, 0)
+                count += 1
+        if count: self.ring.flush()
+        return count
+
+    def newest(self, count):
+        """Return a list of the newest entries, newest first."""
+        slots = self._live_slots()
+        slots.sort()
+        slots.reverse()
+        entries = []
+        for modified, slot in slots[:count]:
+            pos = self._slot_pos(slot)
+            length = RING_SLOT_HEADER.unpack(
+                self.ring[pos:pos + RING_SLOT_HEADER.size])[1]
+            pos += RING_SLOT_HEADER.size
+            try:
+                entries.append(loads(self.ring[pos:pos + length]))
+            except Exception:
+                # Skip slots scribbled on by a crash mid-write.
+                pass
+        return entries
+
+    def close(self):
+        """Unmap and close the ring buffer file."""
+        self.ring.close()
+        self.fd.close()
+
+    def _fit_entry(self, entry):
+        """
+        Return a pickle of the entry small enough for a slot.  If need be
+        the summary is trimmed and marked as such, in a copy of the entry
+        so the caller's is left alone.
+        """
+        room = self.slot_size - RING_SLOT_HEADER.size
+        data = dumps(entry, HIGHEST_PROTOCOL)
+        if len(data) <= room: return data
+
+        summary = entry.data.get('summary', '')
+        entry   = FeedEntryDict(entry.data, entry.date_fmt)
+        while len(data) > room:
+            if not summary:
+                raise ValueError("Entry too big for a %s byte ring slot" %
+                                 self.slot_size)
+            cut = len(summary) - (len(data) - room) - len(RING_TRUNCATED)
+            summary = (cut > 0) and summary[:cut] or ''
+            entry['summary'] = summary and (summary + RING_TRUNCATED)
+            data = dumps(entry, HIGHEST_PROTOCOL)
+        return data
+
+    def _live_slots(self):
+        """Return a list of (modified, slot) for slots holding entries."""
+        live = []
+        room = self.slot_size - RING_SLOT_HEADER.size
+        for slot in xrange(self.num_slots):
+            pos = self._slot_pos(slot)
+            modified, length = RING_SLOT_HEADER.unpack(
+                self.ring[pos:pos + RING_SLOT_HEADER.size])
+            if length and length <= room: live.append((modified, slot))
+        return live
+
+    def _slot_pos(self, slot):
+        """Return the file offset of a slot."""
+        return RING_HEADER.size + slot * self.slot_size
+
+    def _read_header(self):
+        """Return the (magic, slots, slot size, next slot) header."""
+        return RING_HEADER.unpack(self.ring[:RING_HEADER.size])
+
+    def _write_next(self, next_slot):
+        """Update the next slot to write in the header."""
+        self.ring[:RING_HEADER.size] = RING_HEADER.pack(
+            RING_MAGIC, self.num_slots, self.slot_size, next_slot)
+
+def read_ring_header(ring_path):
+    """
+    Return the (magic, slots, slot size, next slot) header of a ring 
+    buffer file, or None if the file isn't a whole ring buffer.
+    """
+    fin = open(ring_path, 'rb')
+    try:
+        data = fin.read(RING_HEADER.size)
+        if len(data) < RING_HEADER.size: return None
+        header = RING_HEADER.unpack(data)
+        magic, num_slots, slot_size, next_slot = header
+        fin.seek(0, 2)
+        if magic != RING_MAGIC or not num_slots or \
+                slot_size <= RING_SLOT_HEADER.size or \
+                next_slot >= num_slots or \
+                fin.tell() != RING_HEADER.size + num_slots * slot_size:
+            return None
+        return header
+    finally:
+        fin.close()
+
 if __name__ == '__main__': main()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+"""
+pollsched
+
+Adaptive per-feed polling schedule.  Works out when each feed should
+next be polled from publisher hints (RSS <ttl>, sy:updatePeriod), HTTP
+cache headers, and the history of changes seen on recent polls.
+"""
+import sys, time, heapq, rfc822
+
+# Bounds and starting point for the interval between polls, in seconds.
+MIN_INTERVAL     = 15 * 60
+DEFAULT_INTERVAL = 60 * 60
+MAX_INTERVAL     = 24 * 60 * 60
+
+# Number of recent polls remembered, and how much to adjust the
+# interval after a change or a long run of no changes.
+HISTORY_LEN = 10
+SPEEDUP     = 0.5
+BACKOFF     = 1.5
+
+# Seconds per sy:updatePeriod value.
+UPDATE_PERIODS = {
+    'hourly'  : 60 * 60,
+    'daily'   : 24 * 60 * 60,
+    'weekly'  : 7 * 24 * 60 * 60,
+    'monthly' : 30 * 24 * 60 * 60,
+    'yearly'  : 365 * 24 * 60 * 60,
+}
+
+def main():
+    """
+    Print out the polling schedule kept in a feed database.
+    """
+    import shelve
+    feed_db = shelve.open(sys.argv[1], 'r')
+    sched   = PollScheduler(feed_db)
+    now     = time.time()
+    for next_poll, uri in sched.schedule():
+        print "%s  %s%s" % \
+            (time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(next_poll)),
+             (next_poll <= now) and "(due) " or "", uri)
+    feed_db.close()
+
+def publisherInterval(feed_data):
+    """
+    Return the minimum interval in seconds between polls requested by
+    the feed itself, or None if the feed makes no request.
+    """
+    feed, hints = feed_data.get('feed', {}), []
+
+    # RSS 2.0 <ttl> is given in minutes.
+    try:
+        hints.append(int(feed['ttl']) * 60)
+    except (KeyError, TypeError, ValueError):
+        pass
+
+    # RSS 1.0 syndication module gives a period and frequency per period.
+    period = feed.get('sy_updateperiod', '').strip().lower()
+    if UPDATE_PERIODS.has_key(period):
+        try:
+            freq = max(int(feed.get('sy_updatefrequency', 1)), 1)
+        except (TypeError, ValueError):
+            freq = 1
+        hints.append(UPDATE_PERIODS[period] / freq)
+
+    return hints and max(hints) or None
+
+def httpInterval(headers, now=None):
+    """
+    Return the number of seconds for which HTTP cache headers say the
+    feed will stay fresh, or None if the headers say nothing useful.
+    """
+    if now is None: now = time.time()
+    headers = dict([ (k.lower(), v) for k, v in (headers or {}).items() ])
+
+    # Cache-Control max-age takes precedence over Expires.
+    cc = [ x.strip().lower()
+           for x in headers.get('cache-control', '').split(',') ]
+    if 'no-cache' in cc or 'no-store' in cc:
+        return None
+    for directive in cc:
+        if directive.startswith('max-age='):
+            try:
+                return max(int(directive[8:]), 0)
+            except ValueError:
+                pass
+
+    # Work out Expires relative to the server's Date, if there is one.
+    expires = rfc822.parsedate_tz(headers.get('expires', ''))
+    if expires:
+        date = rfc822.parsedate_tz(headers.get('date', ''))
+        base = date and rfc822.mktime_tz(date) or now
+        return max(rfc822.mktime_tz(expires) - base, 0)
+
+    return None
+
+def nextPoll(feed_data, changed, interval=None, history=None, now=None):
+    """
+    Given the result of a poll and whether the feed had changed, along
+    with the feed's previous interval and change history, return a
+    (next_poll, interval, history) tuple for the feed.
+    """
+    if now is None:      now = time.time()
+    if interval is None: interval = DEFAULT_INTERVAL
+    history = ( list(history or []) + [ changed and 1 or 0 ] )[-HISTORY_LEN:]
+
+    # Poll sooner after a change.  Back off only once none of the
+    # remembered polls have turned up anything new, so that a feed
+    # which changes every few polls holds steady.
+    if changed:
+        interval = interval * SPEEDUP
+    elif sum(history) == 0:
+        interval = interval * BACKOFF
+    interval = min(max(interval, MIN_INTERVAL), MAX_INTERVAL)
+
+    # Never poll sooner than the publisher or HTTP caching asks, but
+    # don't let those hints push the next poll past the maximum.
+    delay = interval
+    for hint in (publisherInterval(feed_data),
+                 httpInterval(feed_data.get('headers', {}), now)):
+        if hint is not None:
+            delay = max(delay, min(hint, MAX_INTERVAL))
+
+    return (now + delay, interval, history)
+
+class PollScheduler:
+    """
+    Priority queue of next poll times for feeds.  The queue is kept in
+    a dict-like database (such as the feed_db shelve) under a reserved
+    key, so it persists alongside the rest of the feed notes.
+    """
+    DB_KEY = '__poll_schedule__'
+
+    def __init__(self, db=None):
+        """
+        Initialize the scheduler, loading any queue saved in the db.
+        """
+        self.db    = db
+        self.queue = []
+        if db is not None and db.has_key(self.DB_KEY):
+            self.queue = list(db[self.DB_KEY])
+
+        # Map of URI to current next poll time.  Entries in the queue
+        # which disagree with this map are stale, and get skipped.
+        self.next_polls = dict([ (uri, t) for t, uri in self.queue ])
+
+    def isDue(self, uri, now=None):
+        """
+        Return whether a feed is due for polling.  Feeds never
+        scheduled are always due.
+        """
+        if now is None: now = time.time()
+        return self.next_polls.get(uri, 0) <= now
+
+    def nextPollTime(self, uri):
+        """Return the scheduled next poll time for a feed, if any."""
+        return self.next_polls.get(uri, None)
+
+    def scheduleFeed(self, uri, next_poll):
+        """Set the next poll time for a feed."""
+        self.next_polls[uri] = next_poll
+        heapq.heappush(self.queue, (next_poll, uri))
+
+    def unscheduleFeed(self, uri):
+        """Forget about a feed, eg. after unsubscribing."""
+        if self.next_polls.has_key(uri):
+            del self.next_polls[uri]
+
+    def dueFeeds(self, now=None):
+        """
+        Return the URIs of all scheduled feeds which are due, earliest
+        first, leaving them in the queue.
+        """
+        if now is None: now = time.time()
+        due, seen = [], []
+        while self.queue and self.queue[0][0] <= now:
+            t, uri = heapq.heappop(self.queue)
+            if self.next_polls.get(uri, None) == t:
+                due.append(uri)
+                seen.append((t, uri))
+        for item in seen:
+            heapq.heappush(self.queue, item)
+        return due
+
+    def nextDue(self):
+        """
+        Return the (next_poll, uri) of the next feed due, or None if
+        nothing is scheduled.
+        """
+        while self.queue:
+            t, uri = self.queue[0]
+            if self.next_polls.get(uri, None) == t:
+                return (t, uri)
+            heapq.heappop(self.queue)
+        return None
+
+    def schedule(self):
+        """Return a sorted list of (next_poll, uri) for all feeds."""
+        return sorted([ (t, uri) for uri, t in self.next_polls.items() ])
+
+    def save(self):
+        """Compact the queue and save it back to the db."""
+        self.queue = [ (t, uri) for uri, t in self.next_polls.items() ]
+        heapq.heapify(self.queue)
+        if self.db is not None:
+            self.db[self.DB_KEY] = self.queue
+
+if __name__=='__main__': main()
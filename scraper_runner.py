@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+"""
+scraper_runner.py
+
+Run a set of scrapers in parallel worker processes, in place of a cron
+entry per scraper.  Scrapers are listed in a config file, one section
+per job, eg.:
+
+    [fcc]
+    class   = ch09_fcc_scraper.FCCScraper
+    output  = www/feeds/fcc.%s
+
+    [yahoo-news]
+    class   = ch13_yahoo_news_scraper.YahooNewsScraper
+    args    = my-app-id
+              python
+    output  = www/feeds/yahoo-news.%s
+    formats = atom
+    timeout = 120
+
+Each job builds its scraper from the class (given any constructor
+arguments, one per line), and writes each format named to the output
+filename template.  Every class is imported once, up front, so worker
+processes forked from the runner skip the imports.  Jobs whose scrapers
+share a STATE_FN run one at a time, since they share state files.  Jobs
+running past their timeout are killed.  A summary of timings and failures is printed
+at the end.
+"""
+import sys, os.path, time, traceback
+from ConfigParser import ConfigParser
+from multiprocessing import Process, Queue
+from Queue import Empty
+
+MAX_PROCS       = 4
+DEFAULT_TIMEOUT = 5 * 60
+DEFAULT_FORMATS = 'atom rss'
+POLL_INTERVAL   = 0.1
+
+def main():
+    """
+    Run the scraper jobs in a config file, and exit with the number of
+    jobs which failed.
+    Usage: scraper_runner.py <config file> [max processes]
+    """
+    max_procs = (len(sys.argv) > 2) and int(sys.argv[2]) or MAX_PROCS
+    jobs      = loadJobs(sys.argv[1])
+    results   = runJobs(jobs, max_procs)
+    print formatSummary(results)
+    sys.exit(len([ x for x in results if x[1] != 'ok' ]))
+
+class ScraperJob:
+    """
+    A scraper class, with its constructor arguments, output filename
+    template, formats, and time limit.
+    """
+    def __init__(self, name, class_path, output, args=(),
+            formats=DEFAULT_FORMATS.split(), timeout=DEFAULT_TIMEOUT):
+        """Initialize the job details."""
+        self.name       = name
+        self.class_path = class_path
+        self.output     = output
+        self.args       = list(args)
+        self.formats    = list(formats)
+        self.timeout    = timeout
+        self.cls        = None
+        self.error      = None
+        self.state_fn   = None
+
+    def load(self):
+        """
+        Import the job's scraper class, noting any error rather than
+        raising it, and the state filename the class uses.
+        """
+        try:
+            self.cls = importClass(self.class_path)
+        except Exception, e:
+            self.error = "%s: %s" % (e.__class__.__name__, e)
+            return False
+        state_fn = getattr(self.cls, 'STATE_FN', None)
+        if state_fn: self.state_fn = os.path.abspath(state_fn)
+        return True
+
+    def run(self):
+        """Build the scraper, and scrape the feeds to their files."""
+        scraper = self.cls(*self.args)
+        scraper.scrape_many(self.formats, self.output)
+
+def loadJobs(config_fn):
+    """Return a list of ScraperJobs from a config file."""
+    config = ConfigParser()
+    config.read(config_fn)
+    jobs = []
+    for name in config.sections():
+        opts = dict(config.items(name, True))
+        jobs.append(ScraperJob(name, opts['class'], opts['output'],
+            [ x.strip() for x in opts.get('args', '').split('\n')
+              if x.strip() ],
+            opts.get('formats', DEFAULT_FORMATS).split(),
+            float(opts.get('timeout', DEFAULT_TIMEOUT))))
+    return jobs
+
+def importClass(class_path):
+    """Import and return a class given its dotted module path."""
+    module_name, class_name = class_path.rsplit('.', 1)
+    module = __import__(module_name, {}, {}, [ class_name ])
+    return getattr(module, class_name)
+
+def runJobs(jobs, max_procs=MAX_PROCS):
+    """
+    Run jobs in up to max_procs worker processes at once, and return a
+    list of (name, status, seconds, message) tuples in job order, where
+    status is one of 'ok', 'error', 'timeout' or 'import'.  Jobs with
+    the same state filename never run at the same time, but wait their
+    turn while other jobs go ahead.
+    """
+    results = {}
+    for job in jobs:
+        if not job.load():
+            results[job.name] = (job.name, 'import', 0.0, job.error)
+
+    pending = [ x for x in jobs if not results.has_key(x.name) ]
+    running = {}
+    queue   = Queue()
+
+    while pending or running:
+
+        # Start jobs while there are free workers, skipping any whose 
+        # state files are in use by a running job.
+        busy = [ x[0].state_fn for x in running.values() ]
+        for job in pending[:]:
+            if len(running) >= max_procs: break
+            if job.state_fn is not None and job.state_fn in busy: continue
+            pending.remove(job)
+            busy.append(job.state_fn)
+            proc = Process(target=runWorker, args=(job, queue))
+            proc.start()
+            running[job.name] = (job, proc, time.time())
+
+        # Collect any results reported by finished workers.
+        try:
+            while True:
+                name, status, message = queue.get(True, POLL_INTERVAL)
+                job, proc, start = running.pop(name)
+                proc.join()
+                results[name] = (name, status, time.time() - start, message)
+        except Empty:
+            pass
+
+        # Kill workers running past their time limit, and note any which
+        # died without reporting back.
+        now = time.time()
+        for name, (job, proc, start) in running.items():
+            if now - start > job.timeout:
+                proc.terminate()
+                proc.join()
+                del running[name]
+                results[name] = (name, 'timeout', now - start,
+                                 "Killed after %s seconds" % job.timeout)
+            elif not proc.is_alive() and queue.empty():
+                proc.join()
+                del running[name]
+                results[name] = (name, 'error', now - start,
+                                 "Worker exited with code %s" % proc.exitcode)
+
+    return [ results[x.name] for x in jobs ]
+
+def runWorker(job, queue):
+    """Run a job in a worker process, and report how it went."""
+    try:
+        job.run()
+        queue.put((job.name, 'ok', ''))
+    except Exception:
+        queue.put((job.name, 'error', traceback.format_exc()))
+
+def formatSummary(results):
+    """Return a report of job results, with failure details."""
+    lines, failures = [], []
+    for name, status, secs, message in results:
+        lines.append("%-8s %8.2fs  %s" % (status, secs, name))
+        if status != 'ok':
+            failures.append("%s (%s):\n%s" % (name, status, message.rstrip()))
+    ok = len([ x for x in results if x[1] == 'ok' ])
+    lines.append("%s of %s jobs succeeded, slowest %0.2fs" %
+                 (ok, len(results), max([0.0] + [ x[2] for x in results ])))
+    return "\n".join(lines + [ '' ] + failures)
+
+if __name__ == '__main__': main()
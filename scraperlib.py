@@ -3,15 +3,33 @@ scraperlib
 
 Useful base classes and utilities for HTML page scrapers.
 """
-import sys, time, re, shelve, popen2, calendar, md5
+import sys, os, time, re, shelve, whichdb, popen2, calendar, md5
+import cPickle as pickle
+from itertools import islice
+from cStringIO import StringIO
 from urllib import quote
-from urllib2 import urlopen
 from urlparse import urljoin, urlparse
 from xml.sax.saxutils import escape
 from HTMLParser import HTMLParser, HTMLParseError
+from fetchlib import fetch, FetchCache
+from sqlitelib import sqlite3
 
 UNICODE_ENC = "UTF-8"
 
+# Filename suffix for scraper state databases.
+STATE_SUFFIX = ".sqlite"
+
+# Scraper state records for entries not seen in this long are evicted.
+STATE_MAX_AGE = 30 * 24 * 60 * 60
+
+# How stale a record's last seen time can get before it's written again.
+STATE_SEEN_RESOLUTION = 24 * 60 * 60
+
+# Filename suffixes for the cache of source page validators and content,
+# and for the feeds last rendered from the source.
+FETCH_SUFFIX  = "_fetch"
+OUTPUT_SUFFIX = "_output"
+
 class FeedEntryDict:
     """
     This class is a wrapper around HTMLMetaDoc objects meant to 
@@ -26,7 +44,8 @@ class FeedEntryDict:
         """
         self.data = {}
         self.data.update(init_dict)
-        self.date_fmt = date_fmt
+        self.date_fmt  = date_fmt
+        self._prepared = {}
        
     def __cmp__(self, other):
         """Reverse chronological order on modified date"""
@@ -35,9 +54,47 @@ class FeedEntryDict:
     def __setitem__(self, name, val):
         """Set a value in the feed entry dict."""
         self.data[name] = val
+        self._prepared = {}
         
     def __getitem__(self, name):
         """Return a dict item, escaped and encoded for XML inclusion"""
+        return self.format_value(name, self.date_fmt)
+
+    def prepare(self, names, date_fmt=None):
+        """
+        Return a dict of values for the given template field names, 
+        escaped and encoded for XML inclusion.  Values are remembered, 
+        so preparing the entry for several templates does the work 
+        once, with dates remembered per format.  Only call this once 
+        the entry's data is final, since changes made directly to 
+        self.data won't be noticed.
+        """
+        if date_fmt is None: date_fmt = self.date_fmt
+        cache = getattr(self, '_prepared', None)
+        if cache is None:
+            cache = self._prepared = {}
+
+        values = {}
+        for name in names:
+            key = name.startswith('entry.') and name[6:] or name
+            if key in self.DATE_KEYS: key = (key, date_fmt)
+            if not cache.has_key(key):
+                cache[key] = self.format_value(name, date_fmt)
+            values[name] = cache[key]
+        return values
+
+    def format_value(self, name, date_fmt):
+        """
+        Return a dict item, escaped and encoded for XML inclusion, with
+        dates formatted using the given format.
+        """
+        return escape(self.raw_value(name, date_fmt))
+
+    def raw_value(self, name, date_fmt):
+        """
+        Return a dict item, encoded but not escaped, with dates 
+        formatted using the given format.
+        """
         # Chop off the entry. prefix, if found.
         if name.startswith('entry.'): 
             name = name[6:]
@@ -45,16 +102,15 @@ class FeedEntryDict:
         # If this key is a date, format accordingly.
         if name in self.DATE_KEYS:
             date = self.data.get(name, time.time())
-            val  = time.strftime(self.date_fmt, time.gmtime(date))
+            val  = time.strftime(date_fmt, time.gmtime(date))
 
         # Otherwise, try returning what was asked for.
         else: 
             val = self.data.get(name, '')
         
-        # Make sure the value is finally safe for inclusion in XML
         if type(val) is unicode:
             val = val.encode(self.UNICODE_ENC)
-        return escape(val.strip())
+        return val.strip()
     
     def id(self):
         """Come up with a state DB ID for this entry."""
@@ -72,6 +128,232 @@ class FeedEntryDict:
             
         return id
 
+JSON_ESCAPES = {
+    '"'  : '\\"',  '\\' : '\\\\', '\n' : '\\n', '\r' : '\\r',
+    '\t' : '\\t', '\b' : '\\b',  '\f' : '\\f',
+    # U+2028 and U+2029 in UTF-8, which JavaScript won't take unescaped.
+    '\xe2\x80\xa8' : '\\u2028', '\xe2\x80\xa9' : '\\u2029',
+}
+JSON_ESCAPE_RE = re.compile(r'["\\\x00-\x1f]|\xe2\x80[\xa8\xa9]')
+
+def json_quote(val):
+    """
+    Return a UTF-8 string as a quoted JSON string.  Quotes, backslashes,
+    control characters and line separators are escaped, and everything 
+    else is passed through as UTF-8, which JSON allows.
+    """
+    def quote_char(m):
+        c = m.group(0)
+        return JSON_ESCAPES.get(c) or '\\u%04x' % ord(c)
+    return '"%s"' % JSON_ESCAPE_RE.sub(quote_char, val)
+
+class CompiledTemplate:
+    """
+    String template using %(name)s style fields, parsed once into a list
+    of literal text and field parts for repeated rendering.
+    """
+    FIELD_RE = re.compile(
+        r'%(?:(%)|\((?P<name>[^)]*)\)(?P<spec>[-#0 +]*\d*(?:\.\d+)?[a-zA-Z]))')
+
+    def __init__(self, tmpl):
+        """
+        Parse the template into (literal, name, spec) parts, where name
+        and spec are None for trailing literal text.
+        """
+        self.parts, self.names, literal, pos = [], [], [], 0
+        for m in self.FIELD_RE.finditer(tmpl):
+            literal.append(tmpl[pos:m.start()])
+            pos = m.end()
+            if m.group(1):
+                literal.append('%')
+            else:
+                self.parts.append((''.join(literal), 
+                                   m.group('name'), m.group('spec')))
+                if m.group('name') not in self.names:
+                    self.names.append(m.group('name'))
+                literal = []
+        literal.append(tmpl[pos:])
+        self.parts.append((''.join(literal), None, None))
+
+    def render(self, values):
+        """
+        Fill in the template from a dict of values for its fields.
+        """
+        out = []
+        for literal, name, spec in self.parts:
+            out.append(literal)
+            if name is None: 
+                continue
+            elif spec == 's' and type(values[name]) is str:
+                out.append(values[name])
+            else:
+                out.append(('%' + spec) % values[name])
+        return ''.join(out)
+
+_compiled_templates = {}
+
+def compile_template(tmpl):
+    """
+    Return a CompiledTemplate for a template string, reusing one already
+    compiled for the same string.
+    """
+    if not _compiled_templates.has_key(tmpl):
+        _compiled_templates[tmpl] = CompiledTemplate(tmpl)
+    return _compiled_templates[tmpl]
+
+def write_atomic(files):
+    """
+    Write a list of (filename, data) pairs, each first to a temporary 
+    file alongside the real one, which then get renamed into place once 
+    all have been written.  Readers never see a partly written file.
+    """
+    tmp_fns = []
+    try:
+        for fn, data in files:
+            tmp_fn = '%s.tmp-%s' % (fn, os.getpid())
+            tmp_fns.append(tmp_fn)
+            fout = open(tmp_fn, 'wb')
+            fout.write(data)
+            fout.close()
+        for tmp_fn, (fn, data) in zip(tmp_fns, files):
+            os.rename(tmp_fn, fn)
+    finally:
+        for tmp_fn in tmp_fns:
+            if os.path.exists(tmp_fn): os.unlink(tmp_fn)
+
+class StateStore:
+    """
+    Store of per-entry scraper state records, keyed by entry ID.  All 
+    records are read in one query when opened, changes are made in 
+    memory, and only new or changed records are written back, in one
+    transaction, on flush.  Each record notes when its entry was last
+    seen, so records for entries long gone can be evicted.
+    """
+    def __init__(self, state_fn, max_age=STATE_MAX_AGE):
+        """
+        Open the store, importing records from an older shelve of the 
+        same name if there is one.
+        """
+        if sqlite3 is None:
+            raise ImportError("StateStore requires sqlite3 or pysqlite2")
+        self.state_fn = state_fn
+        self.max_age  = max_age
+
+        self.conn = sqlite3.connect(state_fn + STATE_SUFFIX)
+        self.conn.text_factory = str
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS state (
+                id        TEXT PRIMARY KEY,
+                last_seen REAL,
+                data      BLOB
+            )""")
+        self.conn.execute("""
+            CREATE INDEX IF NOT EXISTS state_last_seen ON state (last_seen)
+        """)
+        self.conn.commit()
+
+        # Map of ID to (last seen, pickled record) as found in the db,
+        # records unpickled so far, and IDs seen on this run.
+        self.stored  = dict([ (id, (last_seen, str(data))) 
+            for id, last_seen, data in 
+            self.conn.execute("SELECT id, last_seen, data FROM state") ])
+        self.records = {}
+        self.seen    = {}
+
+        if not self.stored and whichdb.whichdb(state_fn):
+            self._import_shelve()
+
+    def has_key(self, id):
+        """Return whether there's a state record for an ID."""
+        return self.records.has_key(id) or self.stored.has_key(id)
+    __contains__ = has_key
+
+    def __getitem__(self, id):
+        """
+        Return the state record for an ID.  Changes made to the record 
+        in place are picked up when the store is flushed.
+        """
+        if not self.records.has_key(id):
+            self.records[id] = pickle.loads(self.stored[id][1])
+        return self.records[id]
+
+    def __setitem__(self, id, record):
+        """Set the state record for an ID."""
+        self.records[id] = record
+
+    def get(self, id, default=None):
+        """Return the state record for an ID, or a default if none."""
+        if self.has_key(id): return self[id]
+        return default
+
+    def touch(self, id, now=None):
+        """Note that the entry for an ID was seen."""
+        if now is None: now = time.time()
+        self.seen[id] = now
+
+    def flush(self):
+        """
+        Write new and changed records, along with updated last seen 
+        times, in one transaction.  Returns the number of records written.
+        """
+        rows, now = [], time.time()
+        ids = dict.fromkeys(self.records.keys() + self.seen.keys())
+        for id in ids.keys():
+            if not self.has_key(id): continue
+            last_seen, old_data = self.stored.get(id, (0, None))
+            if self.records.has_key(id):
+                data = pickle.dumps(self.records[id], 
+                                    pickle.HIGHEST_PROTOCOL)
+            else:
+                data = old_data
+            seen = self.seen.get(id, last_seen or now)
+            if data != old_data or \
+                    seen - last_seen > STATE_SEEN_RESOLUTION:
+                rows.append((id, seen, sqlite3.Binary(data)))
+                self.stored[id] = (seen, data)
+        if rows:
+            self.conn.executemany("""
+                INSERT OR REPLACE INTO state (id, last_seen, data) 
+                VALUES (?, ?, ?)
+            """, rows)
+            self.conn.commit()
+        return len(rows)
+
+    def evict(self, max_age=None):
+        """
+        Delete records for entries not seen within the maximum age, and
+        return how many were deleted.
+        """
+        if max_age is None: max_age = self.max_age
+        cutoff = time.time() - max_age
+        cur = self.conn.execute("DELETE FROM state WHERE last_seen < ?", 
+                                (cutoff,))
+        self.conn.commit()
+        for id, (last_seen, data) in self.stored.items():
+            if last_seen < cutoff:
+                del self.stored[id]
+                if self.records.has_key(id): del self.records[id]
+        return cur.rowcount
+
+    def close(self):
+        """Flush changes, evict stale records, and close the database."""
+        self.flush()
+        self.evict()
+        self.conn.close()
+
+    def _import_shelve(self):
+        """
+        Import records from a shelve at the store's filename, as written
+        by earlier versions of the scraper.  They're treated as seen 
+        now, so they get a full maximum age before eviction.
+        """
+        old_db, now = shelve.open(self.state_fn, 'r'), time.time()
+        for id in old_db.keys():
+            self.records[id] = old_db[id]
+            self.seen[id]    = now
+        old_db.close()
+        self.flush()
+
 class _ScraperFinishedException(Exception):
     """
     Private exception, raised when the scraper has seen all it's 
@@ -123,6 +405,20 @@ RSS_FEED_TMPL = """<?xml version="1.0" encoding="utf-8"?>
 </rss>
 """
 
+JSON_DATE_FMT = ATOM_DATE_FMT
+
+# JSON feed members, with the FEED_META key or entry field for each.
+JSON_FEED_FIELDS = [
+    ('title', 'feed.title'), ('link', 'feed.link'), 
+    ('tagline', 'feed.tagline'), ('modified', 'feed.modified'),
+]
+JSON_AUTHOR_FIELDS = [
+    ('name', 'feed.author.name'), ('email', 'feed.author.email'), 
+    ('url', 'feed.author.url'),
+]
+JSON_ENTRY_FIELDS = [ 'title', 'link', 'id', 'issued', 'modified', 
+                      'summary' ]
+
 RSS_ENTRY_TMPL = """
         <item>
             <title>%(entry.title)s</title>
@@ -147,10 +443,14 @@ class Scraper:
         'feed.author.url'   : 'http://www.decafbad.com',
         'feed.modified'     : ''
     }
-    SORT_ENTRIES = True
-    MAX_ENTRIES  = 15
-    BASE_HREF    = ""
-    SCRAPE_URL   = ""
+    SORT_ENTRIES  = True
+    MAX_ENTRIES   = 15
+    STATE_MAX_AGE = STATE_MAX_AGE
+    BASE_HREF     = ""
+    SCRAPE_URL    = ""
+    REUSE_OUTPUT  = True
+    prefetched    = None
+    source_hash   = None
 
     ATOM_DATE_FMT   = ATOM_DATE_FMT
     ATOM_FEED_TMPL  = ATOM_FEED_TMPL
@@ -159,6 +459,11 @@ class Scraper:
     RSS_DATE_FMT    = RSS_DATE_FMT
     RSS_FEED_TMPL   = RSS_FEED_TMPL
     RSS_ENTRY_TMPL  = RSS_ENTRY_TMPL
+
+    # JSON isn't rendered from templates, see render_json_feed().
+    JSON_DATE_FMT   = JSON_DATE_FMT
+    JSON_FEED_TMPL  = None
+    JSON_ENTRY_TMPL = None
     
     def scrape_atom(self):
         """Scrape the page and return an Atom feed."""
@@ -172,13 +477,214 @@ class Scraper:
         return self.scrape(self.RSS_ENTRY_TMPL, 
                 self.RSS_FEED_TMPL, self.RSS_DATE_FMT)
         
+    def scrape_many(self, formats=('atom', 'rss'), fn_tmpl=None):
+        """
+        Scrape the page once and return a dict of feeds, one for each of 
+        the named formats.  Each format name refers to a set of 
+        <NAME>_ENTRY_TMPL, <NAME>_FEED_TMPL and <NAME>_DATE_FMT 
+        attributes, or to a render_<name>_feed() method, as with 'json'
+        which can't be built from XML-escaped template values.  Feed 
+        metadata is produced using the date format of
+        the first format named.  If given a filename template, such as 
+        "feeds/foo.%s", each feed is also written to the filename for its
+        format, replacing all the files at once when every feed is built.
+        Files for feeds which haven't changed are left alone.
+        """
+        fmts = [ self.get_format(x) for x in formats ]
+
+        # Scrape and polish up the entries, using the first date format.
+        if 'atom' in formats or 'json' in formats:
+            self.FEED_META['feed.modified'] = \
+                time.strftime(self.ATOM_DATE_FMT, time.gmtime(time.time()))
+        self.date_fmt = fmts[0][2]
+        feeds = self.build_feeds(zip(formats, fmts))
+
+        # Write out all the changed feeds, if a filename template was given.
+        if fn_tmpl is not None:
+            write_atomic([ (fn_tmpl % x, feeds[x]) for x in formats
+                           if x not in self.unchanged_feeds or
+                              not os.path.exists(fn_tmpl % x) ])
+
+        return feeds
+
+    def build_feeds(self, formats):
+        """
+        Given a list of (name, (entry template, feed template, date 
+        format)) tuples, return a dict of named feeds.  The rendered 
+        feeds are remembered alongside STATE_FN, each with a hash of the
+        source page it was rendered from, so when the page hasn't changed
+        since they were rendered they're reused without scraping the page
+        at all.  The names of feeds found to be unchanged are left in 
+        self.unchanged_feeds.
+        """
+        keys = [ self.output_key(x) for name, x in formats ]
+        self.unchanged_feeds = []
+        feeds = {}
+
+        out_db = shelve.open(self.STATE_FN + OUTPUT_SUFFIX)
+        try:
+            # Reuse the last feeds rendered, if every feed asked for was
+            # rendered from the source as it is now.  Feeds are rendered
+            # by separate runs, say one per format, so one rendered from 
+            # an older page, or missing, makes this a miss, and the page
+            # gets scraped from a full fetch.
+            self.source_unchanged(out_db.get('source_hash', None))
+            stored = [ out_db.get(x, None) for x in keys ]
+            if self.source_hash is not None and \
+                    [ x and x[0] for x in stored ] == \
+                    [ self.source_hash ] * len(keys):
+                for (name, fmt), record in zip(formats, stored):
+                    feeds[name] = record[2]
+                self.unchanged_feeds = feeds.keys()
+                return feeds
+
+            # Otherwise, scrape and render as usual.
+            entries = self.prepare_entries()
+            for (name, (entry_tmpl, feed_tmpl, date_fmt)), key in \
+                    zip(formats, keys):
+                render = getattr(self, 'render_%s_feed' % name, None)
+                if render is not None:
+                    feed = feeds[name] = render(entries, date_fmt)
+                else:
+                    feed = feeds[name] = self.render_feed(entries, 
+                        entry_tmpl, feed_tmpl, date_fmt)
+                if self.source_hash is None: continue
+
+                # Remember the feed, and note whether it came out as it
+                # did last time.
+                feed_hash = md5.md5(feed).hexdigest()
+                if out_db.has_key(key) and out_db[key][1] == feed_hash:
+                    self.unchanged_feeds.append(name)
+                out_db[key] = (self.source_hash, feed_hash, feed)
+
+            if self.source_hash is not None:
+                out_db['source_hash'] = self.source_hash
+
+        finally:
+            out_db.close()
+        
+        return feeds
+
+    def output_key(self, fmt):
+        """
+        Return the key under which a feed rendered with the given 
+        (entry template, feed template, date format) is remembered.  The
+        key also covers the other settings that affect the output, so 
+        changing them means the feed gets rendered afresh.
+        """
+        meta = [ x for x in self.FEED_META.items() 
+                 if x[0] != 'feed.modified' ]
+        meta.sort()
+        m = md5.md5()
+        for part in fmt + (self.date_fmt, self.MAX_ENTRIES, meta):
+            m.update('%r\0' % (part,))
+        return 'output:%s' % m.hexdigest()
+
+    def source_unchanged(self, last_hash):
+        """
+        Fetch the source page and return whether it's the same as when
+        it was last scraped, with either a 304 or identical content.  
+        The fetched content is held for the next fetch_source() call, 
+        and its hash left in self.source_hash.  Scrapers not scraping 
+        SCRAPE_URL, or with REUSE_OUTPUT turned off, are never unchanged.
+        """
+        self.source_hash = None
+        if not (self.REUSE_OUTPUT and self.SCRAPE_URL):
+            return False
+
+        # A scraper reading only the start of the page can't hash all 
+        # of it, so goes by a 304 or the page validators instead.  A 304
+        # here has no content to scrape, so it isn't held on to, and 
+        # fetch_source() fetches the page in full if it's needed.
+        if self.partial_source():
+            resp = self.fetch_conditional()
+            if resp.not_modified and last_hash is not None:
+                resp.close()
+                self.source_hash = last_hash
+                return True
+            validators = [ resp.headers.get(x, None) 
+                           for x in ('etag', 'last-modified') ]
+            if validators != [ None, None ]:
+                self.source_hash = 'validators:%s' % \
+                    md5.md5(repr(validators)).hexdigest()
+            if resp.not_modified:
+                resp.close()
+            else:
+                self.prefetched = resp
+            return False
+
+        resp = self.fetch_source()
+        data = resp.read()
+        resp.close()
+        self.prefetched  = StringIO(data)
+        self.source_hash = md5.md5(data).hexdigest()
+        return self.source_hash == last_hash
+
+    def fetch_source(self):
+        """
+        Fetch the page at SCRAPE_URL with a conditional GET, using the
+        validators and content cached from the last fetch.  Returns a 
+        file-like fetchlib.FetchResponse, also kept as self.source, 
+        whose not_modified flag is set if the page hasn't changed.  If 
+        the page was already fetched to check for changes, a file-like
+        holding that content is returned instead.
+
+        The response always has content to scrape.  A 304 for a page 
+        whose content wasn't cached, because it was last read only in 
+        part, is followed by an unconditional fetch.
+        """
+        if self.prefetched is not None:
+            fin, self.prefetched = self.prefetched, None
+            return fin
+        resp = self.fetch_conditional()
+        if resp.not_modified and not resp.has_body:
+            resp = self.fetch_conditional(False)
+        return resp
+
+    def fetch_conditional(self, conditional=True):
+        """
+        Fetch the page at SCRAPE_URL, with a conditional GET unless told
+        otherwise, and return the fetchlib.FetchResponse, also kept as
+        self.source.  A 304 may come without any content to read.
+        """
+        cache = FetchCache(self.STATE_FN + FETCH_SUFFIX)
+        self.source = fetch(self.SCRAPE_URL, cache, 
+                            partial=self.partial_source(),
+                            conditional=conditional)
+        return self.source
+
+    def partial_source(self):
+        """
+        Return whether this scraper may stop reading the source page 
+        before the end.  Scrapers which stop early should override this.
+        """
+        return False
+
+    def get_format(self, name):
+        """
+        Return the (entry template, feed template, date format) for a
+        named feed format.
+        """
+        prefix = name.upper()
+        return ( getattr(self, '%s_ENTRY_TMPL' % prefix),
+                 getattr(self, '%s_FEED_TMPL' % prefix),
+                 getattr(self, '%s_DATE_FMT' % prefix) )
+        
     def scrape(self, entry_tmpl, feed_tmpl, date_fmt):
         """
         Given an entry and feed string templates, scrape an HTML page for 
         content and use the templates to return a feed.
         """
         self.date_fmt = date_fmt
-        self.state_db = shelve.open(self.STATE_FN)
+        feeds = self.build_feeds([ ('feed', (entry_tmpl, feed_tmpl, None)) ])
+        return feeds['feed']
+
+    def prepare_entries(self):
+        """
+        Produce entries from the source, fill in their links, dates and
+        IDs with help from the state database, and return them sorted.
+        """
+        self.state_db = StateStore(self.STATE_FN, self.STATE_MAX_AGE)
 
         # Scrape the source data for FeedEntryDict instances
         entries = self.produce_entries()
@@ -186,8 +692,9 @@ class Scraper:
         # Make a polishing-up run through the extracted entries.
         for e in entries:
 
-            # Come up with ID for state db
+            # Come up with ID for state db, and note it's been seen.
             state_id = e.id()
+            self.state_db.touch(state_id)
             
             # Make sure the entry link is absolute
             if e.data.has_key('link'):
@@ -195,9 +702,7 @@ class Scraper:
             
             # Try to get state for this ID, creating a new record
             # if needed.
-            if not self.state_db.has_key(state_id): 
-                self.state_db[state_id] = {}
-            entry_state = self.state_db[state_id]
+            entry_state = self.state_db.get(state_id, {})
             
             # Manage remembered values for datestamps when entry data 
             # first found, unless dates were extracted.
@@ -224,14 +729,21 @@ class Scraper:
             # Update the state database record
             self.state_db[state_id] = entry_state
 
-        # Close the state database
+        # Write out changed state records and close the state database
         self.state_db.close()
                     
         # Sort the entries, now that they all should have dates.
         if self.SORT_ENTRIES: entries.sort()
-        
+
+        return entries
+
+    def render_feed(self, entries, entry_tmpl, feed_tmpl, date_fmt=None):
+        """
+        Render prepared entries into a feed using the given templates.
+        """
         # Build the entries from template, and populate the feed data
-        entries_out = [entry_tmpl % e for e in entries[:self.MAX_ENTRIES]]
+        entries_out = self.render_entries(entries[:self.MAX_ENTRIES],
+                                          entry_tmpl, date_fmt)
         feed = { 'feed.entries' : "\n".join(entries_out) }
 
         # Add all the feed metadata into the feed, ensuring 
@@ -243,6 +755,43 @@ class Scraper:
         
         # Return the built feed
         return feed_tmpl % feed
+
+    def render_json_feed(self, entries, date_fmt=None):
+        """
+        Render prepared entries into a JSON feed, with the feed metadata
+        and a list of entries.
+        """
+        meta = {}
+        for k, v in self.FEED_META.items():
+            if type(v) is unicode:
+                v = v.encode(self.UNICODE_ENC)
+            meta[k] = v
+
+        def members(pairs, indent):
+            return (',\n' + indent).join([ '%s: %s' % 
+                (json_quote(k), json_quote(v)) for k, v in pairs ])
+
+        entries_out = [ '        {\n            %s\n        }' % 
+            members([ (x, e.raw_value(x, date_fmt or e.date_fmt)) 
+                      for x in JSON_ENTRY_FIELDS ], '            ')
+            for e in entries[:self.MAX_ENTRIES] ]
+        author = members([ (k, meta.get(x, '')) 
+                           for k, x in JSON_AUTHOR_FIELDS ], '        ')
+
+        return '{\n    %s,\n    "author": {\n        %s\n    },\n' \
+               '    "entries": [\n%s\n    ]\n}\n' % (
+            members([ (k, meta.get(x, '')) for k, x in JSON_FEED_FIELDS ], 
+                    '    '), author, ',\n'.join(entries_out))
+
+    def render_entries(self, entries, entry_tmpl, date_fmt=None):
+        """
+        Render a list of entries using an entry template, compiling the
+        template once and filling it from each entry's prepared values.
+        Dates use each entry's own format, unless one is given.
+        """
+        tmpl = compile_template(entry_tmpl)
+        return [ tmpl.render(e.prepare(tmpl.names, date_fmt)) 
+                 for e in entries ]
     
 class RegexScraper(Scraper):
     """
@@ -251,6 +800,12 @@ class RegexScraper(Scraper):
     # Default regex extracts all hyperlinks.
     ENTRY_RE = """(?P<summary><a href="(?P<link>.*?)">(?P<title>.*?)</a>)"""
 
+    # Streaming mode reads the source a chunk at a time, holding back a
+    # window as long as the longest expected match between chunks.
+    STREAM_ENTRIES = False
+    CHUNK_SIZE     = 64 * 1024
+    MAX_MATCH_LEN  = 16 * 1024
+
     def __init__(self):
         """Initialize the scraper, compile the regex"""
         self.entry_re = re.compile(self.ENTRY_RE, 
@@ -259,7 +814,18 @@ class RegexScraper(Scraper):
     def produce_entries(self):
         """Use regex to extract entries from source"""
         # Fetch the source for scraping.
-        src = urlopen(self.SCRAPE_URL).read()
+        fin = self.fetch_source()
+        try:
+            # In streaming mode, extract entries as the source is read,
+            # stopping once there are enough if they won't be sorted.
+            if self.STREAM_ENTRIES:
+                entries = self.iter_entries(fin)
+                if not self.SORT_ENTRIES:
+                    entries = islice(entries, self.MAX_ENTRIES)
+                return list(entries)
+            src = fin.read()
+        finally:
+            fin.close()
 
         # Iterate through all the matches of the regex found.
         entries, pos = [], 0
@@ -277,8 +843,55 @@ class RegexScraper(Scraper):
         
         return entries
 
+    def iter_entries(self, fin):
+        """
+        Read the source from a file-like object a chunk at a time, and
+        yield a FeedEntryDict for each match of the regex.  A match is 
+        only trusted once MAX_MATCH_LEN characters past its start have 
+        been read, so that more input can't change it, and that much is
+        carried over between chunks.
+        """
+        buf, eof = '', False
+        while not eof:
+            chunk = fin.read(self.CHUNK_SIZE)
+            eof   = (len(chunk) == 0)
+            buf  += chunk
+
+            # Yield all the matches which can be trusted so far.
+            pos = 0
+            while True:
+                m = self.entry_re.search(buf, pos)
+                if not m: break
+                if not eof and m.start() + self.MAX_MATCH_LEN > len(buf): 
+                    break
+                pos = m.end()
+                yield FeedEntryDict(m.groupdict(), self.date_fmt)
+
+            # No match can start before the carry-over window anymore.
+            buf = buf[max(pos, len(buf) - self.MAX_MATCH_LEN):]
+
+    def partial_source(self):
+        """Streaming without sorting may stop before the end."""
+        return self.STREAM_ENTRIES and not self.SORT_ENTRIES
+
 from tidylib import tidy_string
 from Ft.Xml.Domlette import NonvalidatingReader
+from Ft.Xml.XPath import Compile
+from Ft.Xml.XPath.Context import Context
+
+# Filename suffix for the cache of tidied source.
+TIDY_SUFFIX = "_tidy"
+
+_compiled_xpaths = {}
+
+def compile_xpath(path):
+    """
+    Return a compiled XPath expression, reusing one already compiled 
+    for the same string.
+    """
+    if not _compiled_xpaths.has_key(path):
+        _compiled_xpaths[path] = Compile(path)
+    return _compiled_xpaths[path]
 
 class XPathScraper(Scraper):
     """
@@ -293,40 +906,145 @@ class XPathScraper(Scraper):
         'link'    : './@href',
         'summary' : './text()'
     }
+
+    # Batch mode evaluates each entry xpath once over the whole document,
+    # rather than once per entry node.
+    BATCH_XPATHS = False
     
     def produce_entries(self):
         """Use xpaths to extract feed entries and entry attributes."""
         # Fetch the HTML source, tidy it up, parse it.
-        src      = urlopen(self.SCRAPE_URL).read()
-        tidy_src = tidy_string(src)
+        src      = self.fetch_source().read()
+        tidy_src = self.tidy_source(src)
         doc      = NonvalidatingReader.parseString(tidy_src, self.SCRAPE_URL)
 
-        entries = []
+        # Find the parts identified as feed entry nodes, and extract the
+        # entry attributes from each.
+        entry_nodes = self.eval_xpath(self.ENTRIES_XPATH, doc)
+        if self.BATCH_XPATHS:
+            entries_data = self.extract_batched(doc, entry_nodes)
+        else:
+            entries_data = [ self.extract_entry(x) for x in entry_nodes ]
 
-        # Iterate through the parts identified as feed entry nodes.
-        for entry_node in doc.xpath(self.ENTRIES_XPATH, self.NSS):
+        # Create the FeedEntryDicts for the extractions.
+        return [ FeedEntryDict(data, self.date_fmt) 
+                 for data in entries_data ]
 
-            # For each entry attribute path, attempt to extract the value
-            data = {}
-            for k,v in self.ENTRY_XPATHS.items():
-                nodes   = entry_node.xpath(v, self.NSS)
-                vals    = [x.nodeValue for x in nodes if x.nodeValue]
-                data[k] = " ".join(vals)
-                
-            # Create and append the FeedEntryDict for this extraction
-            entries.append(FeedEntryDict(data, self.date_fmt))
-        
-        return entries
+    def tidy_source(self, src):
+        """
+        Return the source tidied up, reusing the tidied source saved
+        alongside STATE_FN if the source hasn't changed since.
+        """
+        src_hash = md5.md5(src).hexdigest()
+        tidy_db  = shelve.open(self.STATE_FN + TIDY_SUFFIX)
+        try:
+            if tidy_db.get('hash', None) == src_hash:
+                return tidy_db['tidy']
+            tidy_src = tidy_string(src)
+            tidy_db['hash'] = src_hash
+            tidy_db['tidy'] = tidy_src
+            return tidy_src
+        finally:
+            tidy_db.close()
+
+    def eval_xpath(self, path, node):
+        """Evaluate an xpath, compiled once, with a node as context."""
+        return compile_xpath(path).evaluate(
+            Context(node, processorNss=self.NSS))
+
+    def extract_entry(self, entry_node):
+        """
+        Return a dict of entry attributes, evaluating each attribute 
+        path against the entry node.
+        """
+        data = {}
+        for k,v in self.ENTRY_XPATHS.items():
+            nodes   = self.eval_xpath(v, entry_node)
+            vals    = [x.nodeValue for x in nodes if x.nodeValue]
+            data[k] = " ".join(vals)
+        return data
+
+    def extract_batched(self, doc, entry_nodes):
+        """
+        Return a list of dicts of entry attributes, one per entry node.
+        Each attribute path which only looks down from the entry node, 
+        such as './text()' or './/@href', is appended to ENTRIES_XPATH 
+        and evaluated once over the document.  Each resulting node is 
+        credited to the nearest entry node among its ancestors.  Other 
+        paths are evaluated per entry node, as usual.
+        """
+        index = {}
+        for idx in range(len(entry_nodes)):
+            index[entry_nodes[idx]] = idx
+        entries_data = [ {} for x in entry_nodes ]
+
+        for k,v in self.ENTRY_XPATHS.items():
+            if v.startswith('./') and '..' not in v and '|' not in v:
+                vals = [ [] for x in entry_nodes ]
+                path = '(%s)/%s' % (self.ENTRIES_XPATH, v[2:])
+                for node in self.eval_xpath(path, doc):
+                    idx = self.find_entry(node, index)
+                    if idx is not None and node.nodeValue:
+                        vals[idx].append(node.nodeValue)
+            else:
+                vals = [ [ x.nodeValue for x in self.eval_xpath(v, n) 
+                           if x.nodeValue ] for n in entry_nodes ]
+            for data, val in zip(entries_data, vals):
+                data[k] = " ".join(val)
+
+        return entries_data
+
+    def find_entry(self, node, index):
+        """
+        Return the index of the nearest entry node at or above a node,
+        or None if there isn't one.
+        """
+        while node is not None:
+            if index.has_key(node): return index[node]
+            node = getattr(node, 'ownerElement', None) or node.parentNode
+        return None
     
 class HTMLScraper(HTMLParser, Scraper):
     """
     Base class for HTMLParser-based feed scrapers.
     """
-    CHUNKSIZE   = 1024
+    # Reads start at CHUNKSIZE and double up to MAX_CHUNKSIZE, so small
+    # pages and early exits don't over-read while big pages get fed to 
+    # the parser in fewer, larger pieces.
+    CHUNKSIZE     = 1024
+    MAX_CHUNKSIZE = 64 * 1024
+
+    # Whether to stop fetching the page, as well as parsing it, once the
+    # end of the feed has been found.  Pages read only in part can't be
+    # hashed to spot that they're unchanged, so this only pays off for
+    # big pages served with an ETag or Last-Modified header.
+    STOP_FETCH    = False
 
     def produce_entries(self):
-        fin = urlopen(self.SCRAPE_URL)
-        return self.parse_file(fin)
+        fin = self.fetch_source()
+        try:
+            return self.parse_file(fin)
+        finally:
+            fin.close()
+
+    def partial_source(self):
+        """Stopping the fetch early means the page isn't read in full."""
+        return self.STOP_FETCH
+
+    def fetch_report(self):
+        """
+        Return a (bytes read, bytes available) tuple for the last fetch
+        of the source page, as sent over the network.  Bytes available is 
+        None if the server didn't say.
+        """
+        source = getattr(self, 'source', None)
+        if source is None: return (0, None)
+        try:
+            available = int(source.headers.get('content-length', None))
+        except (TypeError, ValueError):
+            available = None
+        if source.not_modified: available = 0
+        return (source.bytes_read, available)
         
     def reset(self):
         """Initialize the parser state."""
@@ -342,6 +1060,14 @@ class HTMLScraper(HTMLParser, Scraper):
 
     def end_feed(self):
         """Handle end of all useful feed scraping."""
+        self.stop_scraping()
+
+    def stop_scraping(self):
+        """
+        Stop parsing the page, and fetching it too if STOP_FETCH is set.
+        Subclasses can call this at any point once they have what they 
+        need.
+        """
         raise _ScraperFinishedException()
             
     def start_feed_entry(self):
@@ -371,12 +1097,23 @@ class HTMLScraper(HTMLParser, Scraper):
     def parse_file(self, fin):
         """Parse through the contents of a given file-like object."""
         self.reset()
+        chunk_size = self.CHUNKSIZE
         while True:
             try:
-                data = fin.read(self.CHUNKSIZE)
+                data = fin.read(chunk_size)
                 if len(data) == 0: break
                 self.feed(data)
             except _ScraperFinishedException:
+                # Read out the rest of the page, unless stopping the
+                # fetch along with the parsing.
+                if not self.STOP_FETCH:
+                    while fin.read(self.MAX_CHUNKSIZE): pass
                 break
+
+            # Grow the chunk size, and make sure the next chunk is big 
+            # compared to any partial markup the parser is holding on 
+            # to, since it gets scanned again with each chunk fed.
+            chunk_size = max(min(chunk_size * 2, self.MAX_CHUNKSIZE), 
+                             len(self.rawdata) * 2)
         return self.feed_entries
            
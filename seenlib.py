@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+"""
+seenlib
+
+Store of entry hashes already seen by an aggregator.  Hashes live in a
+SQLite table along with when each was first seen, so old ones can be
+pruned, and an in-memory bloom filter answers most "seen it?" checks
+without touching the disk.
+"""
+import sys, os, os.path, time, math, md5, shelve, whichdb
+import cPickle as pickle
+from array import array
+from sqlitelib import sqlite3
+
+# Filename suffixes for the hash database and its saved bloom filter.
+DB_SUFFIX    = ".seen"
+BLOOM_SUFFIX = ".bloom"
+
+# Seen entries older than this are forgotten.  This should be well past
+# the point where any feed still carries an entry.
+MAX_AGE = 90 * 24 * 60 * 60
+
+# Bloom filter sizing: the fewest entries to plan for, and the false
+# positive rate to aim for.
+BLOOM_MIN_CAPACITY = 100000
+BLOOM_ERROR_RATE   = 0.01
+
+def main():
+    """
+    Report on, and optionally prune, a seen entry store.
+    Usage: seenlib.py <entry db filename> [prune]
+    """
+    store = SeenEntryStore(sys.argv[1])
+    print "%s entries seen" % len(store)
+    if len(sys.argv) > 2 and sys.argv[2] == 'prune':
+        print "Pruned %s entries" % store.prune()
+    store.close()
+
+class BloomFilter:
+    """
+    Simple bloom filter over strings, built on an array of bytes.
+    """
+    def __init__(self, capacity, error_rate=BLOOM_ERROR_RATE):
+        """
+        Initialize an empty filter sized for a number of entries at a
+        given false positive rate.
+        """
+        self.capacity = capacity
+        self.num_bits = int(math.ceil(-capacity * math.log(error_rate) /
+                                      (math.log(2) ** 2)))
+        self.num_hashes = max(1, int(round(
+            (float(self.num_bits) / capacity) * math.log(2))))
+        self.bits  = array('B', [0]) * ((self.num_bits + 7) / 8)
+        self.count = 0
+
+    def _positions(self, key):
+        """
+        Yield the bit positions for a key, using double hashing on two
+        halves of its MD5 digest.
+        """
+        digest = md5.md5(key).hexdigest()
+        h1, h2 = int(digest[:16], 16), int(digest[16:], 16) | 1
+        for idx in xrange(self.num_hashes):
+            yield (h1 + idx * h2) % self.num_bits
+
+    def add(self, key):
+        """Add a key to the filter."""
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= (1 << (pos & 7))
+        self.count += 1
+
+    def __contains__(self, key):
+        """Return False if the key is definitely absent, True if maybe."""
+        for pos in self._positions(key):
+            if not self.bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def isFull(self):
+        """Return whether the filter holds more than it was sized for."""
+        return self.count > self.capacity
+
+class SeenEntryStore:
+    """
+    Store of seen entry hashes and when they were first seen.  Supports
+    has_key() and item assignment, so it can stand in for the shelve
+    once used for the entry DB.
+    """
+    def __init__(self, db_fn, max_age=MAX_AGE):
+        """
+        Open the store, importing from an older shelve of the same name
+        if there is one, and load up the bloom filter.
+        """
+        if sqlite3 is None:
+            raise ImportError("SeenEntryStore requires sqlite3 or pysqlite2")
+        self.db_fn    = db_fn
+        self.max_age  = max_age
+        self.bloom_fn = db_fn + BLOOM_SUFFIX
+
+        self.conn = sqlite3.connect(db_fn + DB_SUFFIX)
+        self.conn.text_factory = str
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS seen (
+                hash       TEXT PRIMARY KEY,
+                first_seen REAL
+            )""")
+        self.conn.execute("""
+            CREATE INDEX IF NOT EXISTS seen_first_seen ON seen (first_seen)
+        """)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS meta (
+                name  TEXT PRIMARY KEY,
+                value TEXT
+            )""")
+        self.conn.commit()
+
+        if self._getMeta('imported') is None:
+            self._importShelve()
+        self._loadBloom()
+
+    def __len__(self):
+        """Return the number of entries seen."""
+        return self.conn.execute("SELECT COUNT(*) FROM seen").fetchone()[0]
+
+    def has_key(self, hash):
+        """
+        Return whether an entry hash has been seen.  Only hashes which
+        might be in the bloom filter need a trip to the database.
+        """
+        if hash not in self.bloom:
+            return False
+        row = self.conn.execute(
+            "SELECT 1 FROM seen WHERE hash = ?", (hash,)).fetchone()
+        return row is not None
+    __contains__ = has_key
+
+    def __setitem__(self, hash, first_seen):
+        """Mark a single entry hash as seen at the given time."""
+        self.markSeen([hash], first_seen)
+
+    def markSeen(self, hashes, first_seen=None):
+        """
+        Mark a batch of entry hashes as seen, all in one transaction.
+        """
+        if not hashes: return
+        if first_seen is None: first_seen = time.time()
+        self.conn.executemany("""
+            INSERT OR IGNORE INTO seen (hash, first_seen) VALUES (?, ?)
+        """, [ (x, first_seen) for x in hashes ])
+        self._bumpGeneration()
+        self.conn.commit()
+        for hash in hashes:
+            self.bloom.add(hash)
+        if self.bloom.isFull():
+            self._buildBloom()
+
+    def prune(self, max_age=None):
+        """
+        Forget entries first seen longer ago than the maximum age, and
+        return how many were forgotten.  Pruned hashes stay set in the
+        bloom filter, which only costs an extra database lookup if one
+        turns up again.
+        """
+        if max_age is None: max_age = self.max_age
+        cur = self.conn.execute("DELETE FROM seen WHERE first_seen < ?",
+                                (time.time() - max_age,))
+        self.conn.commit()
+        return cur.rowcount
+
+    def close(self):
+        """Save the bloom filter, and close the database."""
+        self._saveBloom()
+        self.conn.close()
+
+    def _getMeta(self, name, default=None):
+        """Get a value from the meta table."""
+        row = self.conn.execute(
+            "SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return (row is not None) and row[0] or default
+
+    def _setMeta(self, name, value):
+        """Set a value in the meta table, without committing."""
+        self.conn.execute(
+            "INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)",
+            (name, str(value)))
+
+    def _bumpGeneration(self):
+        """
+        Note a change to the seen hashes, so that a bloom filter saved
+        before the change won't be trusted.
+        """
+        self.generation = int(self._getMeta('generation', 0)) + 1
+        self._setMeta('generation', self.generation)
+
+    def _importShelve(self):
+        """
+        Import seen hashes from a shelve at the store's filename, as
+        written by earlier versions of the aggregator.
+        """
+        if whichdb.whichdb(self.db_fn):
+            old_db, now = shelve.open(self.db_fn, 'r'), time.time()
+            rows = []
+            for hash in old_db.keys():
+                first_seen = old_db[hash]
+                if type(first_seen) is not float: first_seen = now
+                rows.append((hash, first_seen))
+            old_db.close()
+            self.conn.executemany("""
+                INSERT OR IGNORE INTO seen (hash, first_seen) VALUES (?, ?)
+            """, rows)
+            self._bumpGeneration()
+        self._setMeta('imported', 1)
+        self.conn.commit()
+
+    def _loadBloom(self):
+        """
+        Load the saved bloom filter if it's up to date with the database,
+        otherwise build a fresh one.
+        """
+        self.generation = int(self._getMeta('generation', 0))
+        try:
+            gen, bloom = pickle.load(open(self.bloom_fn, 'rb'))
+            if gen == self.generation:
+                self.bloom = bloom
+                return
+        except (IOError, EOFError, pickle.UnpicklingError):
+            pass
+        self._buildBloom()
+
+    def _buildBloom(self):
+        """
+        Build a bloom filter from all the hashes in the database, sized
+        with room to grow.
+        """
+        self.bloom = BloomFilter(max(BLOOM_MIN_CAPACITY, len(self) * 2))
+        for (hash,) in self.conn.execute("SELECT hash FROM seen"):
+            self.bloom.add(hash)
+
+    def _saveBloom(self):
+        """Save the bloom filter, tagged with the database generation."""
+        pickle.dump((self.generation, self.bloom),
+                    open(self.bloom_fn, 'wb'), pickle.HIGHEST_PROTOCOL)
+
+if __name__ == '__main__': main()
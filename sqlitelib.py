@@ -0,0 +1,16 @@
+"""
+sqlitelib.py
+
+Finds an SQLite module, so the modules that keep state in SQLite don't
+each repeat the search.  sqlite3 comes with Python 2.5 and later, and 
+pysqlite2 provides the same API for older versions.  sqlite3 is None if
+neither is installed, and users should raise ImportError when they find
+that, rather than failing on import.
+"""
+try:
+    import sqlite3
+except ImportError:
+    try:
+        from pysqlite2 import dbapi2 as sqlite3
+    except ImportError:
+        sqlite3 = None
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+"""
+test_fetchlib.py
+
+Tests for fetchlib against a local HTTP server: keep-alive connection
+reuse, gzip and deflate decoding, conditional GETs answered from the
+fetch cache, and the urllib2 fallback for other schemes.
+"""
+import os, shutil, tempfile, threading, unittest, zlib, gzip
+from cStringIO import StringIO
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+import fetchlib
+
+BODY = "All work and no play makes Jack a dull boy.\n" * 1000
+ETAG = '"v1"'
+
+def main():
+    unittest.main()
+
+def gzipData(data):
+    """Return data compressed in gzip format."""
+    buf  = StringIO()
+    fout = gzip.GzipFile(fileobj=buf, mode='wb')
+    fout.write(data)
+    fout.close()
+    return buf.getvalue()
+
+class TestServer(ThreadingMixIn, HTTPServer):
+    """Threaded server, so kept-alive connections don't block others."""
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        """Ignore connections the client drops, as abandoned reads do."""
+        pass
+
+class TestHandler(BaseHTTPRequestHandler):
+    """Serve BODY with various encodings, noting each connection used."""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        """Send BODY, encoded as the path asks, or a 304 for the ETag."""
+        self.server.conns.add(self.client_address)
+        self.server.requests.append(self.path)
+
+        if self.headers.get('If-None-Match', None) == ETAG:
+            self.send_response(304)
+            self.send_header('ETag', ETAG)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        body, encoding = BODY, None
+        if self.path == '/gzip':
+            body, encoding = gzipData(BODY), 'gzip'
+        elif self.path == '/deflate':
+            body, encoding = zlib.compress(BODY), 'deflate'
+        elif self.path == '/raw-deflate':
+            comp = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+            body, encoding = comp.compress(BODY) + comp.flush(), 'deflate'
+
+        self.send_response(200)
+        self.send_header('ETag', ETAG)
+        self.send_header('Content-Length', str(len(body)))
+        if encoding: self.send_header('Content-Encoding', encoding)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        """Keep quiet."""
+        pass
+
+class FetchTests(unittest.TestCase):
+
+    def setUp(self):
+        """Start the server, and make a pool and cache for the tests."""
+        self.server = TestServer(('127.0.0.1', 0), TestHandler)
+        self.server.conns    = set()
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       kwargs={'poll_interval': 0.05})
+        self.thread.setDaemon(True)
+        self.thread.start()
+        self.base = 'http://127.0.0.1:%s' % self.server.server_port
+
+        self.pool    = fetchlib.ConnectionPool(timeout=5)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache   = fetchlib.FetchCache(os.path.join(self.tmp_dir, 'c'))
+
+    def tearDown(self):
+        """Stop the server and clean up."""
+        self.pool.close_all()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def fetchAll(self, path, cache=None):
+        """Fetch a path from the server and return (response, body)."""
+        resp = fetchlib.fetch(self.base + path, cache, pool=self.pool)
+        data = resp.read()
+        resp.close()
+        return (resp, data)
+
+    def testKeepAlive(self):
+        """Fully read responses leave their connection for reuse."""
+        for i in range(3):
+            resp, data = self.fetchAll('/plain')
+            self.assertEqual(data, BODY)
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(len(self.server.conns), 1)
+
+    def testAbandonedNotReused(self):
+        """A response closed partway through doesn't go back to the pool."""
+        resp = fetchlib.fetch(self.base + '/plain', pool=self.pool)
+        resp.read(10)
+        resp.close()
+        self.fetchAll('/plain')
+        self.assertEqual(len(self.server.conns), 2)
+
+    def testGzip(self):
+        """gzip content is decoded."""
+        resp, data = self.fetchAll('/gzip')
+        self.assertEqual(data, BODY)
+        self.assert_(resp.bytes_read < len(BODY))
+
+    def testDeflate(self):
+        """deflate content is decoded, whether zlib or raw."""
+        self.assertEqual(self.fetchAll('/deflate')[1], BODY)
+        self.assertEqual(self.fetchAll('/raw-deflate')[1], BODY)
+
+    def testSizedReads(self):
+        """Reading in pieces returns the whole body in order."""
+        resp  = fetchlib.fetch(self.base + '/gzip', pool=self.pool)
+        parts = []
+        while True:
+            data = resp.read(1000)
+            if not data: break
+            parts.append(data)
+        resp.close()
+        self.assertEqual(''.join(parts), BODY)
+
+    def testNotModifiedFromCache(self):
+        """A 304 reads back the body remembered in the cache."""
+        resp, data = self.fetchAll('/plain', self.cache)
+        self.assertEqual(resp.status, 200)
+        resp, data = self.fetchAll('/plain', self.cache)
+        self.assert_(resp.not_modified)
+        self.assert_(resp.has_body)
+        self.assertEqual(data, BODY)
+
+    def testPartialNotModified(self):
+        """A partial read remembers validators but not the content."""
+        url  = self.base + '/plain'
+        resp = fetchlib.fetch(url, self.cache, pool=self.pool, partial=True)
+        resp.read(10)
+        resp.close()
+        resp = fetchlib.fetch(url, self.cache, pool=self.pool, partial=True)
+        self.assert_(resp.not_modified)
+        self.failIf(resp.has_body)
+        resp = fetchlib.fetch(url, self.cache, pool=self.pool)
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(resp.read(), BODY)
+
+    def testOtherScheme(self):
+        """URLs with other schemes are fetched with urllib2."""
+        fn = os.path.join(self.tmp_dir, 'body.txt')
+        open(fn, 'wb').write(BODY)
+        resp = fetchlib.fetch('file://' + fn)
+        self.assertEqual(resp.read(), BODY)
+        resp.close()
+        self.assertRaises(fetchlib.FetchError, fetchlib.fetch,
+                          'file://' + fn + '.missing')
+
+if __name__ == '__main__': main()
@@ -5,7 +5,7 @@ tidylib.py
 Utility module/program for running web pages through HTML Tidy.
 """
 import sys, popen2
-from urllib2 import urlopen
+from fetchlib import fetch_data
 
 TIDY_CMD  = "/Users/deusx/local/bin/tidy"
 
@@ -41,7 +41,7 @@ except:
 
 def tidy_url(url):
     """Given a URL, return a tidied version of its source."""
-    src = urlopen(url).read()
+    src = fetch_data(url)
     return tidy_string(src)
 
 if __name__=="__main__": main()